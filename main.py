@@ -1,20 +1,22 @@
 from tkinter import *
 from tkinter import ttk
 from tkinter import filedialog as fd
-from tkinter.messagebox import showinfo
+from tkinter.messagebox import showinfo, showerror
 
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib import pyplot as plt
+# matplotlib is imported on first plot (see src.rendering), as it is slow to import
 
-from numpy import argmax
-
-from src.vision import *
-from src.svg import *
-from src.extraction import *
-from src.database import *
-from src.matching import *
+from src.vision import load_image, get_image_line_strings
+from src.extraction import IncrementalExtractor, extract_graph, get_polygons
+from src.database import open_database, close_database, query_database, rank_labels
 from src.labels import LABELS
 
+import threading
+import queue
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
 """
 Adapted from https://python-course.eu/tkinter/canvas-widgets-in-tkinter.php
 """
@@ -23,35 +25,178 @@ Adapted from https://python-course.eu/tkinter/canvas-widgets-in-tkinter.php
 DATABASE
 """
 
-DATABASE = open_database()
+# Future of the database, opened in the background once the window is shown
+DATABASE = None
+
+def load_database(window):
+    """
+    Opens the database in the background, showing it in the window title until it is loaded.
+    """
+    global DATABASE
+
+    DATABASE = ThreadPoolExecutor(max_workers=1).submit(open_database)
+
+    title = window.title()
+    window.title(f"{title} (loading database...)")
+
+    def poll():
+        if DATABASE.done():
+            window.title(title)
+        else:
+            window.after(POLL_INTERVAL, poll)
+
+    poll()
+
+def get_database():
+    """
+    Returns the database, waiting for it to be opened. Must not be called on the Tk main thread.
+    """
+    return DATABASE.result()
 
 def clean_exit():
-    close_database(DATABASE)
+    # Only a loaded database needs to be closed (its changes are already in its write-ahead log)
+    if DATABASE is not None and DATABASE.done() and DATABASE.exception() is None:
+        close_database(DATABASE.result())
     exit()
 
 """
 DRAWN PATHS
 """
 
-PATHS = []
-PATH  = []
+STROKE_CAPACITY = 256 # points, doubled as needed
+
+# Motion events closer than this (pixels) to the last point of the stroke are dropped
+COALESCE_DISTANCE = 2
+
+STROKE_WIDTH = 1
+
+class StrokeBuffer:
+    """
+    The points of the stroke being drawn, in a growing (n, 2) array.
+    """
+
+    def __init__(self, capacity=STROKE_CAPACITY):
+        self.points = np.empty((capacity, 2))
+        self.size = 0
+
+    def append(self, x, y):
+        if self.size == len(self.points):
+            self.points = np.concatenate([self.points, np.empty_like(self.points)])
+
+        self.points[self.size] = (x, y)
+        self.size += 1
+
+    def near(self, x, y, distance=COALESCE_DISTANCE):
+        """
+        Whether the point is closer than distance to the last point of the stroke.
+        """
+        if self.size == 0:
+            return False
+
+        lx, ly = self.points[self.size - 1]
+        return (x - lx)**2 + (y - ly)**2 < distance**2
+
+    def coords(self):
+        """
+        The flat list of coordinates of the stroke, for a canvas line item.
+        """
+        return self.points[:self.size].ravel().tolist()
+
+    def take(self):
+        """
+        Returns the points of the stroke as a view of the buffer (without copying them), 
+        and starts a new stroke in a new buffer.
+        """
+        points = self.points[:self.size]
+
+        self.points = np.empty((STROKE_CAPACITY, 2))
+        self.size = 0
+
+        return points
+
+    def clear(self):
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+PATHS  = []
+STROKE = StrokeBuffer()
 
-def paint(event, canvas, d=0.5):
-   PATH.append((event.x, event.y))
+# Canvas line item of the stroke being drawn
+LINE = None
 
-   x1, y1 = (event.x - d), (event.y - d)
-   x2, y2 = (event.x + d), (event.y + d)
-   canvas.create_rectangle(x1, y1, x2, y2, outline = "black", fill = "black")
+# Number of changes (finished strokes and clears) to the drawn paths, which identifies them
+VERSION = 0
+
+# Strokes are extracted incrementally as they are drawn, on a single 
+# worker thread so that they are processed in order
+EXTRACTOR  = IncrementalExtractor()
+EXTRACTION = ThreadPoolExecutor(max_workers=1)
+
+def start_stroke(event, canvas):
+    """
+    Starts a stroke, drawn as a single line item that grows as the stroke is drawn.
+    """
+    global LINE
+
+    STROKE.clear()
+    STROKE.append(event.x, event.y)
+
+    LINE = canvas.create_line(event.x, event.y, event.x, event.y, fill="black", width=STROKE_WIDTH)
+
+def paint(event, canvas):
+    if LINE is None:
+        start_stroke(event, canvas)
+        return
+
+    # Coalesce motion events too close to be seen
+    if STROKE.near(event.x, event.y):
+        return
+
+    STROKE.append(event.x, event.y)
+    canvas.coords(LINE, STROKE.coords())
 
 def clear(canvas):
+    global LINE, VERSION
+
+    cancel_job()
     canvas.delete('all')
     PATHS.clear()
-    PATH.clear()
+    STROKE.clear()
+    LINE = None
+    VERSION += 1
+    EXTRACTION.submit(EXTRACTOR.clear)
+    clear_speculation(canvas)
 
 def finalize(event):
-    PATH.append((event.x, event.y))
-    PATHS.append(tuple(PATH))
-    PATH.clear()
+    global LINE, VERSION
+
+    if LINE is None:
+        return
+
+    STROKE.append(event.x, event.y)
+    event.widget.coords(LINE, STROKE.coords())
+    LINE = None
+
+    # The stroke's points are handed off to extraction without copying
+    PATHS.append(STROKE.take())
+    VERSION += 1
+    EXTRACTION.submit(EXTRACTOR.add_stroke, PATHS[-1])
+
+    if SPECULATE.get():
+        debounce_speculation(event.widget)
+
+def extracted(mode):
+    """
+    Gets the incrementally extracted line strings, polygons or graph of the drawn paths.
+    """
+    if mode == GRAPH_MODE:
+        return EXTRACTOR.graph('label')
+    elif mode == POLYGON_MODE:
+        return EXTRACTOR.polygons
+    else:
+        return list(EXTRACTOR.line_strings)
 
 """
 PLOTTING
@@ -68,36 +213,58 @@ FILE_INPUT = 1
 
 INPUT_MODE = None
 
-def plot(window, paths):
-    global PREVIOUS, MODE
+def plot(window):
+    # Snapshot the inputs, since the worker must not touch Tk variables
+    mode = MODE.get()
+    input_mode = INPUT_MODE.get()
+    filename = SELECTED_FILE
 
-    # Plot the extracted graph
-    if INPUT_MODE.get() == CANVAS_INPUT:
-        line_strings = get_line_strings(paths)
-        step = 20
-    else:
-        line_strings = get_image_line_strings(load_image(SELECTED_FILE))
-        step = 40
+    def work(cancelled):
+        if input_mode == CANVAS_INPUT:
+            # Only waits for the strokes still being extracted
+            return EXTRACTION.submit(extracted, mode).result()
 
-    if MODE.get() == GRAPH_MODE:
-        fig = plot_graph(extract_graph(line_strings, 'label', check_area=False, step=step))
-    elif MODE.get() == POLYGON_MODE:
-        fig = plot_polygons(get_polygons(line_strings))
-    else:
-        fig = plot_line_strings(line_strings)
+        line_strings = get_image_line_strings(load_image(filename))
 
-    # Destroy previous plot
-    if PREVIOUS is not None:
-        PREVIOUS.destroy()
+        if cancelled.is_set() or mode == LINESTRING_MODE:
+            return line_strings
+        
+        if mode == GRAPH_MODE:
+            return extract_graph(line_strings, 'label', check_area=False, step=40)
+        else:
+            return get_polygons(line_strings)
+
+    def done(result):
+        # Plot the extracted graph
+        renderer = get_renderer(window)
 
-    # create the canvas containing the figure
-    canvas = FigureCanvasTkAgg(fig, master=window)  
-    canvas.draw()
+        if mode == GRAPH_MODE:
+            renderer.show_graph(result)
+        elif mode == POLYGON_MODE:
+            renderer.show_polygons(result)
+        else:
+            renderer.show_line_strings(result)
 
-    # place the canvas on the Tkinter window
-    canvas.get_tk_widget().grid(row = 2, column = 4, columnspan = 2, rowspan = 2)
+    run_in_background(window, work, done)
 
-    PREVIOUS = canvas.get_tk_widget()
+# The single figure plots are shown in, created on first plot
+RENDERER = None
+
+def get_renderer(window):
+    """
+    Returns the renderer of the window, replacing the placeholder canvas with it on first use.
+    """
+    global PREVIOUS, RENDERER
+
+    if RENDERER is None:
+        from src.rendering import Renderer
+
+        RENDERER = Renderer(window, row = 2, column = 4, columnspan = 2, rowspan = 2)
+
+        PREVIOUS.destroy()
+        PREVIOUS = None
+
+    return RENDERER
 
 """
 CLASSIFICATION
@@ -105,43 +272,203 @@ CLASSIFICATION
 
 MSG = None
 
-def submit(window, line_strings):
-    global PREVIOUS, MSG
+def submit(window):
+    key = VERSION
+    speculation = SPECULATION
 
-    # PIPELINE
+    def work(cancelled):
+        # Reuse the speculative query of the same strokes, if any
+        if speculation is not None and speculation[0] == key:
+            return speculation[1].result()
 
-    g = extract_graph(line_strings, 'label', check_area=False)
-    unrefined = query_database(DATABASE, g)
+        # PIPELINE
+        g = EXTRACTION.submit(extracted, GRAPH_MODE).result()
 
-    results = 'default'
-    if MSG is not None:
-        MSG.destroy()
+        if cancelled.is_set():
+            return None
 
-    # Add message to window
-    message = Label(window, text=results, font=("Arial", 25))
-    message.grid(row = 6, column = 4, columnspan = 2)
+        return query_database(get_database(), g)
 
-    MSG = message
+    def done(unrefined):
+        global MSG
 
-    # Destroy previous plot
-    if PREVIOUS is not None:
-        PREVIOUS.destroy()
+        ranked = rank_labels(unrefined)
+
+        results = ranked[0][0] if ranked else 'default'
+        if MSG is not None:
+            MSG.destroy()
+
+        # Add message to window
+        message = Label(window, text=results, font=("Arial", 25))
+        message.grid(row = 6, column = 4, columnspan = 2)
+
+        MSG = message
+
+        # Figure and axis
+        # plt.bar(range(len(LABELS)), dist)
+        # plt.xticks(range(0, len(LABELS), len(LABELS)//10))
+        
+        get_renderer(window).clear()
+
+    run_in_background(window, work, done)
 
-    # Figure Size
-    fig = plt.figure()
+"""
+SPECULATIVE QUERIES
+"""
+
+# Whether to query in the background while sketching
+SPECULATE = None
+
+GUESS = None
+
+DEBOUNCE_INTERVAL = 300 # ms
+
+# Pending debounce callback id
+DEBOUNCED = None
+
+# (strokes, future of query result) of the latest speculative query
+SPECULATION = None
+QUERIES = ThreadPoolExecutor(max_workers=1)
+
+def debounce_speculation(widget):
+    """
+    Schedules a speculative query of the current strokes, once the user
+    has not finished a stroke for a short while.
+    """
+    global DEBOUNCED
+
+    if DEBOUNCED is not None:
+        widget.after_cancel(DEBOUNCED)
+
+    DEBOUNCED = widget.after(DEBOUNCE_INTERVAL, speculate, widget)
+
+def speculate(widget):
+    """
+    Queries the database with the current strokes in the background, 
+    so that submitting them returns instantly, and shows the top label guess.
+    """
+    global DEBOUNCED, SPECULATION
+
+    DEBOUNCED = None
+
+    key = VERSION
+    if SPECULATION is not None and SPECULATION[0] == key:
+        return
+
+    def work():
+        g = EXTRACTION.submit(extracted, GRAPH_MODE).result()
+        return query_database(get_database(), g)
+
+    SPECULATION = (key, QUERIES.submit(work))
+
+    widget.after(POLL_INTERVAL, poll_speculation, widget, SPECULATION)
+
+def poll_speculation(widget, speculation):
+    """
+    Shows the top label guess of a speculative query once it finishes, 
+    unless it was superseded.
+    """
+    key, future = speculation
+
+    if SPECULATION is not speculation:
+        return
+
+    if not future.done():
+        widget.after(POLL_INTERVAL, poll_speculation, widget, speculation)
+        return
+
+    if future.exception() is not None:
+        GUESS.config(text='')
+        return
+
+    ranked = rank_labels(future.result())
+    GUESS.config(text=f"Guess: {ranked[0][0]}" if ranked else '')
+
+def clear_speculation(widget):
+    """
+    Discards the pending and current speculative queries, and the guess.
+    """
+    global DEBOUNCED, SPECULATION
+
+    if DEBOUNCED is not None:
+        widget.after_cancel(DEBOUNCED)
+        DEBOUNCED = None
+
+    SPECULATION = None
+    GUESS.config(text='')
+
+"""
+BACKGROUND WORK
+"""
+
+# Cancellation event of the running job, if any
+JOB = None
+
+PROGRESS = None
+
+POLL_INTERVAL = 50 # ms
+
+def run_in_background(window, work, done):
+    """
+    Runs work(cancelled) in a worker thread, so the window stays responsive, 
+    and then calls done(result) on the Tk main thread. 
     
-    # Figure and axis
-    # plt.bar(range(len(LABELS)), dist)
-    # plt.xticks(range(0, len(LABELS), len(LABELS)//10))
+    Any previously running job is cancelled: its result is discarded,
+    and work functions may check the cancelled event to stop early.
+    """
+    global JOB
+
+    cancel_job()
+
+    cancelled = threading.Event()
+    results = queue.Queue(maxsize=1)
+
+    def target():
+        try:
+            results.put((True, work(cancelled)))
+        except Exception as e:
+            results.put((False, e))
+
+    JOB = cancelled
+    PROGRESS.start()
+
+    threading.Thread(target=target, daemon=True).start()
+
+    window.after(POLL_INTERVAL, poll_job, window, cancelled, results, done)
+
+def poll_job(window, cancelled, results, done):
+    """
+    Polls a background job from the Tk event loop, until it finishes or is cancelled.
+    """
+    global JOB
+
+    if cancelled.is_set():
+        return
+
+    try:
+        ok, result = results.get_nowait()
+    except queue.Empty:
+        window.after(POLL_INTERVAL, poll_job, window, cancelled, results, done)
+        return
     
-    # create the canvas containing the figure
-    canvas = FigureCanvasTkAgg(fig, master=window)  
-    canvas.draw()
+    JOB = None
+    PROGRESS.stop()
+
+    if ok:
+        done(result)
+    else:
+        showerror(title='Error', message=repr(result))
 
-    # place the canvas on the Tkinter window
-    canvas.get_tk_widget().grid(row = 2, column = 4, columnspan = 2, rowspan = 2)
+def cancel_job():
+    """
+    Cancels the running background job, if any.
+    """
+    global JOB
 
-    PREVIOUS = canvas.get_tk_widget()
+    if JOB is not None:
+        JOB.set()
+        JOB = None
+        PROGRESS.stop()
 
 """
 FILE SELECT
@@ -178,7 +505,7 @@ CANVAS_WIDTH  = 800
 CANVAS_HEIGHT = 800
 
 def create_window():
-    global MODE, INPUT_MODE, PATHS, PREVIOUS
+    global MODE, INPUT_MODE, PATHS, PREVIOUS, PROGRESS, SPECULATE, GUESS
 
     # Create window
     master = Tk()
@@ -196,7 +523,7 @@ def create_window():
     INPUT_MODE = IntVar(value=CANVAS_INPUT)
 
     # Create button to plot drawing
-    b = Button(master, text="Plot", command=lambda: plot(master, PATHS))
+    b = Button(master, text="Plot", command=lambda: plot(master))
     b.grid(row = 0, column = 0)
 
     # Create button to clear drawing
@@ -204,7 +531,7 @@ def create_window():
     cb.grid(row = 0, column = 1)
 
     # Create button to exit 
-    eb = Button(master, text="Submit", command=lambda: submit(master, get_line_strings(PATHS)))
+    eb = Button(master, text="Submit", command=lambda: submit(master))
     eb.grid(row = 0, column = 2)
 
     # Create canvas
@@ -218,6 +545,9 @@ def create_window():
     # Paint on canvas on mouse movement
     c.bind("<B1-Motion>", lambda e: paint(e, c))
 
+    # Starting a new stroke cancels any running job, as its input is outdated
+    c.bind("<ButtonPress-1>", lambda e: (cancel_job(), start_stroke(e, c)))
+
     # Stop painting on canvas on mouse release
     c.bind("<ButtonRelease-1>", finalize)
 
@@ -231,6 +561,15 @@ def create_window():
     r3 = Radiobutton(master, text="Linestring", variable=MODE, value=LINESTRING_MODE)
     r3.grid(row = 1, column = 2)
 
+    # Live guess while sketching
+    SPECULATE = BooleanVar(value=False)
+
+    s = Checkbutton(master, text="Live guess", variable=SPECULATE)
+    s.grid(row = 5, column = 0)
+
+    GUESS = Label(master, text='')
+    GUESS.grid(row = 5, column = 1, columnspan = 2)
+
     # --------------------
     # File upload
     # --------------------
@@ -263,6 +602,13 @@ def create_window():
 
     PREVIOUS = placeholder
 
+    # Open the database once the window is shown
+    master.after(0, load_database, master)
+
+    # Progress indicator for background jobs
+    PROGRESS = ttk.Progressbar(master, mode='indeterminate', length=200)
+    PROGRESS.grid(row = 5, column = 4, columnspan = 2)
+
 """
 RUNNER
 """
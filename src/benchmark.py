@@ -0,0 +1,588 @@
+import io
+import json
+import os
+import platform
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from collections import defaultdict
+
+from src.svg import load, to_control_points
+from src.extraction import (extract_graph, get_line_strings, get_polygons, filter_polygons,
+                            get_segments, detect_approximate_polygon, IncrementalExtractor)
+from src.database import Database, open_database, descriptor, DESCRIPTOR_SIZE
+from src.matching import match, build_affinity, mapping_to_list
+from src.similarity import graph_similarity
+from src.graph import compact
+
+"""
+End-to-end benchmarks of the sketch retrieval pipeline.
+
+Times each stage separately over synthetic sketches of increasing size, and stores
+the results as JSON, so that they can be compared between commits:
+
+    python -m src.benchmark --output before.json
+    python -m src.benchmark --output after.json --compare before.json
+
+and checks that startup imports stay within their time budget, that the peak memory 
+of each stage stays within its budget, or that incremental extraction (as in the GUI) 
+extracts the same graphs as extract_graph:
+
+    python -m src.benchmark --imports
+    python -m src.benchmark --memory --sizes 2 4 8 --output memory.json
+    python -m src.benchmark --incremental --sizes 2 4 6
+"""
+
+STAGES = ['load', 'to_control_points', 'get_line_strings', 'get_polygons', 'extract_graph',
+          'descriptor', 'query', 'match', 'graph_similarity']
+
+SIZES  = [2, 4, 6]
+REPEAT = 3
+
+CANVAS_SIZE = 800
+STEP = 20
+
+DATABASE_SIZE = 100
+
+# Matching builds a dense (n1*n2)^2 affinity matrix, so it is skipped for larger graphs
+MAX_MATCH_NODES = 60
+
+# Slowdown ratio reported as a regression by compare
+REGRESSION_THRESHOLD = 1.25
+
+# Import time budgets of the modules loaded at startup, in seconds
+IMPORT_BUDGET = {
+    'src.vision':     0.5,
+    'src.svg':        0.5,
+    'src.extraction': 0.5,
+    'src.database':   1.0,
+    'src.matching':   0.5,
+    'main':           1.5,
+}
+
+# Random sketches per size checked by --incremental
+INCREMENTAL_SKETCHES = 20
+
+# Peak memory budgets of each stage, in MB (of Python and numpy allocations)
+MEMORY_STAGES = ['load', 'get_line_strings', 'get_polygons', 'extract_graph', 'descriptor', 
+                 'build_affinity', 'match', 'open_database']
+
+MEMORY_BUDGET = {
+    'load':             8,
+    'get_line_strings': 8,
+    'get_polygons':     32,
+    'extract_graph':    32,
+    'descriptor':       8,
+    'build_affinity':   128,
+    'match':            256,
+    'open_database':    64,
+}
+
+RSS_INTERVAL = 0.001 # seconds between resident memory samples
+
+"""
+----------------------------
+-- SYNTHETIC SKETCHES
+----------------------------
+"""
+
+def random_strokes(n, rng, points=10, scale=CANVAS_SIZE/10):
+    """
+    n random walk strokes, with steps of the given scale.
+    """
+    starts = rng.uniform(0, CANVAS_SIZE, (n, 1, 2))
+    steps  = rng.normal(0, scale, (n, points - 1, 2))
+
+    walks = np.concatenate([starts, starts + np.cumsum(steps, axis=1)], axis=1)
+
+    return list(np.clip(walks, 0, CANVAS_SIZE))
+
+def grid(n):
+    """
+    n horizontal and n vertical strokes, making a grid of (n-1)^2 cells.
+    """
+    margin = CANVAS_SIZE*0.1
+    ticks = np.linspace(margin, CANVAS_SIZE - margin, n)
+
+    horizontal = [np.array([(margin, t), (CANVAS_SIZE - margin, t)]) for t in ticks]
+    vertical   = [np.array([(t, margin), (t, CANVAS_SIZE - margin)]) for t in ticks]
+
+    return horizontal + vertical
+
+def nested_shapes(n):
+    """
+    n nested squares, each drawn as a single closed stroke.
+    """
+    c = CANVAS_SIZE/2
+    radii = np.linspace(CANVAS_SIZE*0.45, CANVAS_SIZE*0.05, n)
+
+    return [np.array([(c - r, c - r), (c + r, c - r), (c + r, c + r), (c - r, c + r), (c - r, c - r)])
+            for r in radii]
+
+GENERATORS = {
+    'random': lambda n, rng: random_strokes(n, rng),
+    'grid':   lambda n, rng: grid(n),
+    'nested': lambda n, rng: nested_shapes(n),
+}
+
+def fixture_svg(paths):
+    """
+    Renders paths as the text of an SVG file, like the ones of the dataset.
+    """
+    def d(path):
+        return 'M ' + ' L '.join(f"{x:.2f},{y:.2f}" for x, y in path)
+
+    elements = '\n'.join(f'<path d="{d(p)}"/>' for p in paths)
+
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{CANVAS_SIZE}" height="{CANVAS_SIZE}">\n'
+            f'<g fill="none" stroke="black" stroke-width="2">\n{elements}\n</g>\n</svg>')
+
+def synthetic_database(rng, size=DATABASE_SIZE):
+    """
+    A database of random sketches, kept in memory.
+    """
+    kv = defaultdict(list)
+
+    for i in range(size):
+        paths = random_strokes(rng.integers(2, 5), rng)
+        g = extract_graph(get_line_strings(paths, step=STEP), str(i % 10), step=STEP, check_area=False)
+        kv[bytes(descriptor(g, N=DESCRIPTOR_SIZE))].append(compact(g))
+
+    return Database(kv, filename=os.devnull)
+
+"""
+----------------------------
+-- TIMING
+----------------------------
+"""
+
+def timed(f, *args, repeat=REPEAT):
+    """
+    Returns the median wall time of calling f(*args), and its result.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        times.append(time.perf_counter() - start)
+
+    return float(np.median(times)), result
+
+def benchmark_sketch(paths, db, reference, repeat=REPEAT):
+    """
+    Times each pipeline stage on a sketch, and returns the timings and sizes.
+    """
+    t = {}
+
+    text = fixture_svg(paths)
+
+    t['load'], svg = timed(lambda: load(io.StringIO(text)), repeat=repeat)
+    t['to_control_points'], points = timed(lambda: list(map(to_control_points, svg['paths'])), repeat=repeat)
+    t['get_line_strings'], line_strings = timed(get_line_strings, points, STEP, repeat=repeat)
+    t['get_polygons'], polygons = timed(get_polygons, line_strings, repeat=repeat)
+    t['extract_graph'], graph = timed(lambda: extract_graph(line_strings, 'query', step=STEP, check_area=False),
+                                      repeat=repeat)
+    t['descriptor'], _ = timed(descriptor, graph, DESCRIPTOR_SIZE, repeat=repeat)
+    t['query'], _ = timed(db.query, graph, repeat=repeat)
+
+    ref_graph, ref_polygons = reference
+    n = graph.number_of_nodes()
+
+    if 0 < n <= MAX_MATCH_NODES:
+        t['match'], X = timed(match, graph, ref_graph, repeat=repeat)
+
+        polygons = filter_polygons(polygons, step=STEP)
+        pairs = [(polygons[u], ref_polygons[v]) for u, v in mapping_to_list(X, graph, ref_graph)]
+
+        t['graph_similarity'], _ = timed(graph_similarity, pairs, repeat=repeat)
+    else:
+        t['match'] = t['graph_similarity'] = None
+
+    sizes = {
+        'segments': sum(len(get_segments(detect_approximate_polygon(ls))) for ls in line_strings),
+        'polygons': len(polygons),
+        'nodes': n,
+        'edges': graph.number_of_edges(),
+    }
+
+    return t, sizes
+
+def run(sizes=SIZES, repeat=REPEAT, seed=0):
+    """
+    Runs the benchmarks of every generator and size, returning a results dictionary.
+    """
+    rng = np.random.default_rng(seed)
+
+    db = synthetic_database(rng)
+
+    ref_paths = nested_shapes(3)
+    ref_line_strings = get_line_strings(ref_paths, step=STEP)
+    reference = (extract_graph(ref_line_strings, 'reference', step=STEP, check_area=False),
+                 filter_polygons(get_polygons(ref_line_strings), step=STEP))
+
+    results = []
+    for name, generate in GENERATORS.items():
+        for n in sizes:
+            times, counts = benchmark_sketch(generate(n, rng), db, reference, repeat=repeat)
+            results.append({'generator': name, 'size': n, 'times': times, 'sizes': counts})
+
+            print(format_row(name, n, times, counts))
+
+    return {'metadata': metadata(seed, repeat), 'results': results}
+
+def metadata(seed, repeat):
+    """
+    Describes the machine and commit the benchmarks ran on.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'seed': seed,
+        'repeat': repeat,
+    }
+
+def import_time(module, repeat=REPEAT):
+    """
+    Returns the median wall time of importing a module in a fresh interpreter.
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        times.append(float(out.split()[-1]))
+
+    return float(np.median(times))
+
+def check_imports(budget=IMPORT_BUDGET, repeat=REPEAT):
+    """
+    Returns the (module, time, budget) of the modules importing slower than their budget.
+    """
+    over = []
+    for module, limit in budget.items():
+        t = import_time(module, repeat=repeat)
+        print(f"{module:>18}: {t*1000:.0f} ms (budget {limit*1000:.0f} ms)")
+
+        if t > limit:
+            over.append((module, t, limit))
+
+    return over
+
+"""
+----------------------------
+-- MEMORY
+----------------------------
+"""
+
+def rss():
+    """
+    Returns the resident memory of this process in bytes, or None if it can't be read (not Linux).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def measured(f, *args):
+    """
+    Returns the peak traced allocation (bytes) and peak resident memory growth (bytes, or None) 
+    of calling f(*args), and its result. Resident memory is sampled on a thread while f runs.
+    """
+    samples = []
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            samples.append(rss())
+            time.sleep(RSS_INTERVAL)
+
+    base = rss()
+    sampler = threading.Thread(target=sample, daemon=True)
+
+    tracemalloc.reset_peak()
+    traced, _ = tracemalloc.get_traced_memory()
+
+    sampler.start()
+    try:
+        result = f(*args)
+    finally:
+        done.set()
+        sampler.join()
+
+    peak = tracemalloc.get_traced_memory()[1] - traced
+
+    samples = [r for r in samples + [rss()] if r is not None]
+    resident = max(samples) - base if samples and base is not None else None
+
+    return peak, resident, result
+
+def memory_sketch(paths, reference, database):
+    """
+    Measures the peak memory of each stage on a sketch, and returns the peaks and sizes.
+    """
+    peaks = {}
+
+    def measure(name, f, *args):
+        traced, resident, result = measured(f, *args)
+        peaks[name] = {'traced': traced, 'rss': resident}
+        return result
+
+    text = fixture_svg(paths)
+    svg = measure('load', lambda: load(io.StringIO(text)))
+
+    points = list(map(to_control_points, svg['paths']))
+    line_strings = measure('get_line_strings', get_line_strings, points, STEP)
+    measure('get_polygons', get_polygons, line_strings)
+    graph = measure('extract_graph', lambda: extract_graph(line_strings, 'query', step=STEP, check_area=False))
+    measure('descriptor', descriptor, graph, DESCRIPTOR_SIZE)
+
+    n = graph.number_of_nodes()
+    if 0 < n <= MAX_MATCH_NODES:
+        measure('build_affinity', build_affinity, graph, reference)
+        measure('match', match, graph, reference)
+    else:
+        peaks['build_affinity'] = peaks['match'] = None
+
+    measure('open_database', open_database, database)
+
+    return peaks, {'nodes': n, 'edges': graph.number_of_edges()}
+
+def run_memory(sizes=SIZES, seed=0):
+    """
+    Measures the peak memory of every stage, generator and size, returning a results dictionary.
+    """
+    rng = np.random.default_rng(seed)
+
+    reference = extract_graph(get_line_strings(nested_shapes(3), step=STEP), 'reference', step=STEP, 
+                              check_area=False)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'graphs.db')
+        with open(database, 'wb') as f:
+            pickle.dump(synthetic_database(rng), f)
+
+        # Warm up, so that lazy imports and first-call caches aren't measured
+        memory_sketch(nested_shapes(2), reference, database)
+
+        tracemalloc.start()
+        try:
+            for name, generate in GENERATORS.items():
+                for n in sizes:
+                    peaks, counts = memory_sketch(generate(n, rng), reference, database)
+                    results.append({'generator': name, 'size': n, 'peaks': peaks, 'sizes': counts})
+
+                    print(format_memory_row(name, n, peaks, counts))
+        finally:
+            tracemalloc.stop()
+
+    return {'metadata': metadata(seed, 1), 'memory': results}
+
+def over_budget(results, budget=MEMORY_BUDGET):
+    """
+    Returns the (generator, size, stage, peak MB) of stages whose traced peak exceeds their budget.
+    """
+    over = []
+    for r in results['memory']:
+        for s, p in r['peaks'].items():
+            if p is not None and s in budget and p['traced']/2**20 > budget[s]:
+                over.append((r['generator'], r['size'], s, p['traced']/2**20))
+
+    return over
+
+def check_incremental(sizes=SIZES, sketches=INCREMENTAL_SKETCHES, seed=0):
+    """
+    Extracts random sketches of each size stroke by stroke with an IncrementalExtractor, 
+    and with extract_graph. Returns the (size, sketch, difference) of the graphs that differ.
+    """
+    rng = np.random.default_rng(seed)
+    differences = []
+
+    for n in sizes:
+        for k in range(sketches):
+            paths = random_strokes(n, rng)
+
+            extractor = IncrementalExtractor(step=STEP)
+            for path in paths:
+                extractor.add_stroke(path)
+
+            G1 = extractor.graph('query')
+            G2 = extract_graph(get_line_strings(paths, step=STEP), 'query', step=STEP, check_area=False)
+
+            difference = graph_difference(G1, G2)
+            if difference is not None:
+                differences.append((n, k, difference))
+
+    return differences
+
+def graph_difference(G1, G2):
+    """
+    Describes how two topology graphs differ, up to the order of nodes, or returns None if they don't.
+    """
+    if (G1.number_of_nodes(), G1.number_of_edges()) != (G2.number_of_nodes(), G2.number_of_edges()):
+        return (f"{G1.number_of_nodes()} nodes, {G1.number_of_edges()} edges != "
+                f"{G2.number_of_nodes()} nodes, {G2.number_of_edges()} edges")
+
+    F1, F2 = compact(G1).features, compact(G2).features
+    if not np.allclose(F1[np.lexsort(F1.T)], F2[np.lexsort(F2.T)]):
+        return "different node features"
+
+    if not np.allclose(descriptor(G1), descriptor(G2)):
+        return "different descriptors"
+
+    return None
+
+def format_memory_row(name, n, peaks, sizes):
+    def mb(p):
+        if p is None:
+            return '-'
+        resident = '?' if p['rss'] is None else f"{p['rss']/2**20:.1f}"
+        return f"{p['traced']/2**20:.2f}/{resident}"
+
+    counts = ' '.join(f"{k}={v}" for k, v in sizes.items())
+    stages = ' '.join(f"{s}={mb(peaks[s])}" for s in MEMORY_STAGES)
+
+    return f"{name:>8} {n:>4} | {counts} | {stages} (traced/rss MB)"
+
+"""
+----------------------------
+-- REPORTING
+----------------------------
+"""
+
+def format_row(name, n, times, sizes):
+    def ms(t):
+        return '-' if t is None else f"{t*1000:.2f}"
+
+    counts = ' '.join(f"{k}={v}" for k, v in sizes.items())
+    stages = ' '.join(f"{s}={ms(times[s])}" for s in STAGES)
+
+    return f"{name:>8} {n:>4} | {counts} | {stages} (ms)"
+
+def scaling(results, size='segments'):
+    """
+    Scaling curves: for each stage, the (size, time) points over all benchmarks, sorted by size.
+    """
+    curves = defaultdict(list)
+
+    for r in results['results']:
+        for s in STAGES:
+            if r['times'][s] is not None:
+                curves[s].append((r['sizes'][size], r['times'][s]))
+
+    return {s: sorted(points) for s, points in curves.items()}
+
+def compare(baseline, results, threshold=REGRESSION_THRESHOLD):
+    """
+    Returns the (generator, size, stage, ratio) of stages slower than the baseline by more than threshold.
+    """
+    previous = {(r['generator'], r['size']): r['times'] for r in baseline['results']}
+
+    regressions = []
+    for r in results['results']:
+        before = previous.get((r['generator'], r['size']))
+        if before is None:
+            continue
+
+        for s in STAGES:
+            old, new = before.get(s), r['times'][s]
+            if old and new and new / old > threshold:
+                regressions.append((r['generator'], r['size'], s, new / old))
+
+    return regressions
+
+"""
+----------------------------
+-- RUNNER
+----------------------------
+"""
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the sketch retrieval pipeline.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="file to store the results in, as JSON")
+    parser.add_argument('--compare', default=None, help="results file to compare against")
+    parser.add_argument('--imports', action='store_true', help="only check the import time budgets")
+    parser.add_argument('--memory', action='store_true', help="only measure peak memory, and check its budgets")
+    parser.add_argument('--incremental', action='store_true', 
+                        help="only check that incremental extraction matches extract_graph")
+
+    args = parser.parse_args()
+
+    if args.incremental:
+        differences = check_incremental(args.sizes, seed=args.seed)
+        for n, k, difference in differences:
+            print(f"MISMATCH random {n} #{k}: incremental {difference} full")
+
+        if differences:
+            raise SystemExit(1)
+        return
+
+    if args.imports:
+        over = check_imports(repeat=args.repeat)
+        for module, t, limit in over:
+            print(f"OVER BUDGET {module}: {t*1000:.0f} ms > {limit*1000:.0f} ms")
+
+        if over:
+            raise SystemExit(1)
+        return
+
+    if args.memory:
+        results = run_memory(args.sizes, args.seed)
+
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        over = over_budget(results)
+        for generator, n, stage, peak in over:
+            print(f"OVER BUDGET {generator} {n} {stage}: {peak:.1f} MB > {MEMORY_BUDGET[stage]} MB")
+
+        if over:
+            raise SystemExit(1)
+        return
+
+    results = run(args.sizes, args.repeat, args.seed)
+
+    for size in ['segments', 'nodes']:
+        print(f"\nScaling by {size} (ms):")
+        for stage, points in scaling(results, size).items():
+            print(f"{stage:>18}: " + ' '.join(f"{n}:{t*1000:.2f}" for n, t in points))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(baseline, results)
+        for generator, n, stage, ratio in regressions:
+            print(f"REGRESSION {generator} {n} {stage}: {ratio:.2f}x slower")
+
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+import shapely
+
+from cachetools import LRUCache
+
+from src.extraction import extract_graph, DEFAULT_STEP, EXTRACTION_VERSION
+from src.database import descriptor, DESCRIPTOR_SIZE
+
+"""
+Content-addressed cache of extracted graphs and their descriptors.
+
+Entries are keyed by a hash of the (snapped) line string coordinates, the step, the
+descriptor size and the extraction version, so that entries of older extractions aren't
+reused. Since snap rounding maps near-duplicate sketches to the same coordinates,
+re-submitted and slightly different sketches hit the same entry.
+"""
+
+CACHE_SIZE = 1024
+
+class ExtractionCache:
+    """
+    An in-memory LRU cache of (graph, descriptor) pairs, optionally backed by a directory on disk.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, directory=None):
+        self.memory = LRUCache(maxsize=maxsize)
+        self.directory = directory
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def extract(self, line_strings, label, step=DEFAULT_STEP, N=DESCRIPTOR_SIZE):
+        """
+        Returns the graph and descriptor of the line strings, like
+        extract_graph(line_strings, label, step=step, check_area=False) and descriptor(graph, N),
+        extracting them only if they are not cached.
+        """
+        line_strings = list(line_strings)
+
+        k = key(line_strings, step, N)
+
+        value = self.get(k)
+        if value is None:
+            graph = extract_graph(line_strings, label, step=step, check_area=False)
+            value = (graph, descriptor(graph, N=N))
+
+            self.put(k, value)
+
+        graph, d = value
+
+        # Copy, so that callers can't modify cached graphs
+        graph = graph.copy()
+        graph.graph['label'] = label
+
+        return graph, d.copy()
+
+    def get(self, k):
+        with self.lock:
+            value = self.memory.get(k)
+
+        if value is None and self.directory is not None:
+            try:
+                with open(self.path(k), 'rb') as f:
+                    value = pickle.load(f)
+            except FileNotFoundError:
+                pass
+            else:
+                with self.lock:
+                    self.memory[k] = value
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def put(self, k, value):
+        with self.lock:
+            self.memory[k] = value
+
+        if self.directory is not None:
+            # Write to a temporary file first, so concurrent readers never see a partial entry.
+            # Its name is unique, as threads and processes may write the same entry at once
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+                pickle.dump(value, f)
+            os.replace(f.name, self.path(k))
+
+    def path(self, k):
+        return os.path.join(self.directory, f"{k}.p")
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.hits = self.misses = 0
+
+def key(line_strings, step=DEFAULT_STEP, N=DESCRIPTOR_SIZE):
+    """
+    The content hash of a list of line strings, with the extraction parameters and version.
+    """
+    h = hashlib.blake2b(digest_size=20)
+
+    h.update(f"v{EXTRACTION_VERSION}:{step}:{N}:{len(line_strings)}".encode())
+
+    for ls in line_strings:
+        coords = shapely.get_coordinates(ls)
+
+        h.update(len(coords).to_bytes(8, 'little'))
+        h.update(coords.tobytes())
+
+    return h.hexdigest()
@@ -0,0 +1,237 @@
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+from collections import namedtuple
+from itertools import tee
+
+from src.graph import compact
+from src.database import construct_database, construct_sharded_database, descriptor, NORMALIZATIONS, DATABASE_FILENAME
+
+"""
+Append-only, chunked storage of extracted graph corpora.
+
+A corpus is a data file of pickled chunks of records, and an index file (data file + '.idx')
+with the (offset, size, number of records) of each chunk. Records are appended in chunks,
+and a chunk only counts once its index entry is written, after its data is on disk, so a crash
+loses at most the chunk being written. Reading yields one record at a time, loading a single
+chunk in memory, and can be limited to a range of chunks:
+
+    with CorpusWriter('corpus.chunks') as corpus:
+        corpus.write(graph, d, label, filename)
+
+    for record in read_corpus('corpus.chunks'):
+        ...
+
+Check that a corpus recovers from a partially written chunk with: python -m src.corpus --check
+
+Build a database from a corpus with: 
+
+    python -m src.corpus FILENAME [--database FILENAME] [--shards N] [--descriptor-size N] [--normalization KIND]
+"""
+
+CORPUS_FILENAME = "db/corpus.chunks"
+
+CHUNK_SIZE = 256 # records
+
+Record = namedtuple('Record', ['graph', 'descriptor', 'label', 'source'])
+
+# Index entry: offset, size, number of records
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('size', '<i8'), ('count', '<i8')])
+
+class CorpusWriter:
+    """
+    Appends records to a corpus, in chunks.
+    """
+
+    def __init__(self, filename=CORPUS_FILENAME, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.chunk = []
+
+        index = read_index(filename)
+        end = int(index['offset'][-1] + index['size'][-1]) if len(index) else 0
+
+        # Drop any chunk (or index entry) left partially written by a crash
+        with open(index_filename(filename), 'ab') as f:
+            f.truncate(len(index)*INDEX_DTYPE.itemsize)
+
+        self.data = open(filename, 'ab')
+        self.data.truncate(end)
+
+        # Truncating doesn't move the file position, which flush takes chunk offsets from
+        self.data.seek(end)
+        self.index = open(index_filename(filename), 'ab')
+
+    def write(self, graph, descriptor, label=None, source=None):
+        """
+        Appends a record, written to disk once its chunk is full.
+        Graphs are stored as compact graphs.
+        """
+        self.chunk.append((compact(graph), np.asarray(descriptor, dtype=float).tobytes(), label, source))
+
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the records of the current chunk to disk.
+        """
+        if not self.chunk:
+            return
+
+        blob = pickle.dumps(self.chunk)
+        offset = self.data.tell()
+
+        # Data first, then its index entry
+        self.data.write(blob)
+        self.data.flush()
+        os.fsync(self.data.fileno())
+
+        self.index.write(np.array([(offset, len(blob), len(self.chunk))], dtype=INDEX_DTYPE).tobytes())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+
+        self.chunk = []
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def index_filename(filename):
+    return filename + '.idx'
+
+def read_index(filename=CORPUS_FILENAME):
+    """
+    Returns the index of a corpus: the offset, size and number of records of each complete chunk.
+    """
+    try:
+        with open(index_filename(filename), 'rb') as f:
+            buffer = f.read()
+    except FileNotFoundError:
+        return np.empty(0, dtype=INDEX_DTYPE)
+
+    n = len(buffer) // INDEX_DTYPE.itemsize
+    return np.frombuffer(buffer, dtype=INDEX_DTYPE, count=n)
+
+def read_corpus(filename=CORPUS_FILENAME, start=0, stop=None):
+    """
+    Yields the records of the chunks start to stop (exclusive) of a corpus, reading one chunk at a time.
+    """
+    index = read_index(filename)[start:stop]
+
+    with open(filename, 'rb') as f:
+        for offset, size, _ in index:
+            f.seek(offset)
+            for graph, d, label, source in pickle.loads(f.read(size)):
+                yield Record(graph, np.frombuffer(d, dtype=float), label, source)
+
+def corpus_size(filename=CORPUS_FILENAME):
+    """
+    Returns the number of records of a corpus.
+    """
+    return int(read_index(filename)['count'].sum())
+
+def write_corpus(records, filename=CORPUS_FILENAME, chunk_size=CHUNK_SIZE):
+    """
+    Appends (graph, descriptor, label, source) records to a corpus.
+    """
+    with CorpusWriter(filename, chunk_size) as corpus:
+        for r in records:
+            corpus.write(*r)
+
+def corpus_database(filename=CORPUS_FILENAME, database=DATABASE_FILENAME, shards=None, descriptor_size=None, 
+                    normalization='none'):
+    """
+    Constructs a database (sharded by label if shards is given) from the records of a corpus,
+    streaming them from disk. 
+    
+    The stored descriptors are used, unless a descriptor_size is given (e.g. picked by src.tuning) 
+    and they are recomputed with it. The descriptors are normalized with the given normalization.
+    """
+    graphs, descriptors = tee(read_corpus(filename))
+
+    if descriptor_size is None:
+        descriptors = (r.descriptor for r in descriptors)
+    else:
+        descriptors = (descriptor(r.graph, N=descriptor_size) for r in descriptors)
+
+    graphs = (r.graph for r in graphs)
+
+    if shards is None:
+        return construct_database(descriptors, graphs, filename=database, normalization=normalization)
+
+    return construct_sharded_database(descriptors, graphs, shards, filename=database, normalization=normalization)
+
+def check_recovery(graph, chunk_size=2):
+    """
+    Writes a corpus of copies of a graph, appends a partial chunk as a crash would, 
+    then reopens it and writes more records. Returns the error found, or None.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'check.chunks')
+
+        write_corpus([(graph, [i], 'check', str(i)) for i in range(3)], filename, chunk_size)
+
+        with open(filename, 'ab') as f:
+            f.write(b'partial chunk')
+        with open(index_filename(filename), 'ab') as f:
+            f.write(b'partial')
+
+        write_corpus([(graph, [i], 'check', str(i)) for i in range(3, 5)], filename, chunk_size)
+
+        try:
+            sources = [r.source for r in read_corpus(filename)]
+        except Exception as e:
+            return f"corpus unreadable after recovery: {e!r}"
+
+        if sources != [str(i) for i in range(5)]:
+            return f"expected records 0 to 4 after recovery, read {sources}"
+
+    return None
+
+"""
+----------------------------
+-- RUNNER
+----------------------------
+"""
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Construct a database from a graph corpus.")
+    parser.add_argument('corpus', nargs='?', default=CORPUS_FILENAME)
+    parser.add_argument('--database', default=DATABASE_FILENAME)
+    parser.add_argument('--shards', type=int, default=None)
+    parser.add_argument('--descriptor-size', type=int, default=None, help="recompute descriptors with this size")
+    parser.add_argument('--normalization', default='none', choices=NORMALIZATIONS)
+    parser.add_argument('--check', action='store_true', help="check recovery from a partially written chunk, and exit")
+
+    args = parser.parse_args()
+
+    if args.check:
+        import networkx as nx
+
+        G = nx.Graph(label='check')
+        G.add_node(0, position=(0, 0), vertices=4, length=4, area=1, radius=1, bounds=1)
+
+        error = check_recovery(G)
+        print(error or "corpus recovery ok")
+        raise SystemExit(error is not None)
+
+    print(f"{corpus_size(args.corpus)} records in {len(read_index(args.corpus))} chunks")
+
+    corpus_database(args.corpus, args.database, args.shards, args.descriptor_size, args.normalization)
+
+
+if __name__ == "__main__":
+    main()
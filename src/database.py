@@ -2,19 +2,61 @@ import numpy as np
 
 from scipy import linalg
 
-import networkx as nx
-
 from scipy.spatial import KDTree
 
 import pickle
+import mmap
+import os
+import threading
+
+import heapq
+import zlib
+
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
 
-from collections import defaultdict
+from cachetools import LRUCache
+
+from src.instrumentation import stage, staged
+from src.graph import compact, collapse, label_counts, topology_hash, adjacency_matrix
+from src.labels import LABELS
 
 
 DATABASE_FILENAME = "db/graphs.db"
 
+SHARED_DATABASE_FILENAME = "db/graphs.shared"
+
 DESCRIPTOR_SIZE = 7
 
+# Normalizations of descriptors (see Normalization), fitted when constructing a database
+NORMALIZATIONS = ('none', 'scale', 'whiten', 'pca')
+
+# Fraction of the descriptors' variance kept by PCA
+PCA_VARIANCE = 0.99
+
+# Descriptor dimensions with a variance below this (relative to the largest) are considered constant
+MIN_VARIANCE = 1e-9
+
+QUERY_CACHE_SIZE = 1024
+
+# Query descriptors closer than this (per dimension) share cached results
+QUERY_CACHE_QUANTUM = 1e-4
+
+# Query graphs with fewer nodes than this are too ambiguous to be answered by an exact topology match
+EXACT_MATCH_NODES = 3
+
+# Inserts and deletes are appended to a write-ahead log (database file + WAL_EXTENSION),
+# which is folded into the database file in the background once it grows past WAL_COMPACT_SIZE
+WAL_EXTENSION = '.wal'
+
+WAL_COMPACT_SIZE = 16 << 20 # bytes
+
+# Whether each log record is synced to disk before the insert or delete returns
+WAL_SYNC = True
+
+# Log record header: sequence number, size and checksum of the pickled (operation, key, value)
+WAL_HEADER = np.dtype([('sequence', '<i8'), ('size', '<i8'), ('crc', '<u4')])
+
 """
 ------------------------------
 -- On-line functions 
@@ -27,14 +69,23 @@ class Database:
     A database.
     """
 
-    def __init__(self, kv, filename=DATABASE_FILENAME):
+    def __init__(self, kv, filename=DATABASE_FILENAME, index=KDTree, normalization=None):
         """
         Creates a database:
         - A resource handle for an in-disk B+-tree
         - An in-memory KD-tree for querying K nearest neighbors, constructed using keys in B+-tree
+
+        Any other index class with the same query(x, k) interface as a KD-tree can be used.
+
+        If a normalization is given, the KD-tree indexes (and is queried with) normalized descriptors, 
+        while the B+-tree keys stay the descriptors themselves.
         """
         self.filename = filename
         self.kv = kv
+        self.normalization = normalization
+
+        # Sequence number of the last change (insert or delete) applied, see replay
+        self.sequence = 0
 
         descriptors = []
         for d in self.kv:
@@ -44,23 +95,110 @@ class Database:
         
         self.descriptors = np.array(descriptors)
 
-        self.kdtree = KDTree(self.descriptors)
+        self.kdtree = index(self.normalize(self.descriptors))
 
+        # Changes since the KD-tree was built (see insert, delete and fold): the keys of new descriptors,
+        # searched by brute force, and of deleted ones, skipped. The delta is only appended to, 
+        # so that indeces returned by nearest stay valid
+        self.delta = []
+        self.deleted = set()
+
+        self.cache = QueryCache()
+
+        self.index_hashes()
+
+        self.init_log()
+
+    def normalize(self, keys):
+        """
+        Returns the keys (descriptors) in the space of the KD-tree.
+        """
+        if self.normalization is None:
+            return keys
+
+        return self.normalization(keys)
+
+    @property
+    def descriptor_size(self):
+        return self.descriptors.shape[1]
+
+    @staged('query', lambda neighbors, *args, **kwargs: {'neighbors': len(neighbors)})
     def query(self, query_graph, K=50, topK=100):
         """
         Returns the label from the database using a query graph.
         """
-        key = descriptor(query_graph, N=DESCRIPTOR_SIZE)
+        key = descriptor(query_graph, N=self.descriptor_size)
+
+        return self.lookup(key[None, :], K, topK)[0]
+
+    @staged('query_batch', lambda results, *args, **kwargs: {'queries': len(results)})
+    def query_batch(self, query_graphs, K=50, topK=100):
+        """
+        Returns the neighbors of each of the query graphs, using a single KD-tree query.
+        """
+        keys = np.array([descriptor(g, N=self.descriptor_size) for g in query_graphs])
+
+        if keys.size == 0:
+            return []
+
+        return self.lookup(keys, K, topK)
+
+    def lookup(self, keys, K=50, topK=100):
+        """
+        Returns the neighbors of each descriptor (row of keys), from the result cache 
+        or else from the KD-tree.
+        """
+        cache_keys = [self.cache.key(k, K, topK) for k in keys]
+
+        results = [self.cache.get(c) for c in cache_keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+
+        if missing:
+            for i, nearest in zip(missing, self.nearest(keys[missing], K)):
+                results[i] = self.neighbors([j for _, j in nearest], topK)
+                self.cache.put(cache_keys[i], results[i])
+
+        # Copy, so that callers can't modify cached results
+        return [list(r) for r in results]
+
+    def nearest(self, keys, K=50):
+        """
+        Returns the (distance, index) pairs of the K nearest descriptors of each descriptor (row of keys),
+        nearest first. Indeces past the KD-tree's descriptors are the descriptors inserted since it was built.
+        """
+        delta, deleted = list(self.delta), set(self.deleted)
+        keys = self.normalize(keys)
+
+        # Deleted descriptors are skipped, so as many more are queried
+        with stage('kdtree.query', K=K, queries=len(keys)):
+            distances, indeces = self.kdtree.query(keys, k=K + len(deleted))
+
+        n = len(self.descriptors)
+
+        results = [[(d, i) for d, i in zip(np.atleast_1d(ds), np.atleast_1d(ind)) 
+                    if i < n and not (deleted and bytes(self.descriptors[i]) in deleted)]
+                   for ds, ind in zip(np.atleast_1d(distances), np.atleast_1d(indeces))]
 
-        # Query KD-tree for nearest descriptors
-        distances, indeces = self.kdtree.query(key, k=K)
+        delta = [(j, k) for j, k in enumerate(delta) if k not in deleted]
 
-        # Get the features of the neighbors
+        if delta:
+            D = self.normalize(np.array([np.frombuffer(k, dtype=float) for _, k in delta]))
+            distances = np.sqrt(((np.atleast_2d(keys)[:, None, :] - D[None, :, :])**2).sum(axis=2))
+
+            for r, ds in zip(results, distances):
+                r += [(d, n + j) for (j, _), d in zip(delta, ds)]
+                r.sort()
+
+        return [r[:K] for r in results]
+
+    def neighbors(self, indeces, topK=100):
+        """
+        Gets the features of the descriptors at the given indeces, up to topK of them.
+        """
         neighbors = []
 
-        for i in indeces: # assumes they are returned in order of distance
-            k = self.descriptors[i]
-            features = self.kv[bytes(k)] # returns list of graphs
+        for i in indeces: # assumes they are in order of distance
+            features = self.features(i) # returns list of graphs
 
             if len(neighbors) < topK:
                 diff = topK - len(neighbors)
@@ -69,39 +207,372 @@ class Database:
                 break
 
         return neighbors
+
+    def features(self, i):
+        """
+        Gets the features (list of graphs) stored under the i-th descriptor.
+        """
+        # get, as looking up the defaultdict would add a (deleted) descriptor back
+        return self.kv.get(self.key(i), [])
+
+    def key(self, i):
+        """
+        Gets the i-th descriptor's key, of the KD-tree's descriptors and then the inserted ones.
+        """
+        n = len(self.descriptors)
+        return bytes(self.descriptors[i]) if i < n else self.delta[i - n]
     
+    def index_hashes(self):
+        """
+        Indexes the representatives (see collapse) of the database by topology hash.
+        """
+        self.representatives = {g.hash: g for gs in self.kv.values() for g in gs 
+                                if getattr(g, 'hash', None) is not None}
+
+    def exact_match(self, query_graph):
+        """
+        Returns the representative with the same topology as the query graph, or None.
+        Graphs with fewer than EXACT_MATCH_NODES nodes (e.g. empty sketches) aren't matched, 
+        as many graphs of any label share their topology.
+        """
+        if not self.representatives or query_graph.number_of_nodes() < EXACT_MATCH_NODES:
+            return None
+
+        return self.representative(topology_hash(query_graph))
+
+    def representative(self, h):
+        """
+        Returns the representative with the given topology hash, or None.
+        """
+        return self.representatives.get(h)
+
     def close(self):
         """
-        Closes database.
+        Closes database. Changes are already in the write-ahead log, 
+        and are replayed when the database is opened again.
         """
-        self.checkpoint()
+        with self.lock:
+            if self.wal is not None:
+                self.wal.close()
+                self.wal = None
 
     def checkpoint(self):
         """
-        Saves db to disk
+        Saves db to disk, folding the write-ahead log into the database file.
         """
-        with open(self.filename, 'wb') as f:
-            pickle.dump(self, f)
+        self.fold()
 
     def insert(self, k: np.array, v):
-        self.kv[bytes(k)].append(v)
+        v = compact(v)
+        k = bytes(k)
+
+        with self.lock:
+            # A new descriptor is searched by brute force until the KD-tree is rebuilt (see fold)
+            if not self.kv.get(k):
+                if k in self.deleted:
+                    self.deleted.discard(k)
+                else:
+                    self.delta.append(k)
+
+            self.kv[k].append(v)
+            self.log('insert', k, v)
+
+            if getattr(v, 'hash', None) is not None:
+                self.representatives[v.hash] = v
+
+        self.cache.clear()
+        self.compact_log()
 
     def delete(self, k: np.array):
-        del self.kv[bytes(k)]
+        k = bytes(k)
+
+        with self.lock:
+            graphs = self.kv.pop(k)
+            self.log('delete', k)
+
+            self.deleted.add(k)
+
+            for g in graphs:
+                if getattr(g, 'hash', None) is not None and self.representatives.get(g.hash) is g:
+                    del self.representatives[g.hash]
+
+        self.cache.clear()
+        self.compact_log()
+
+    # Write-ahead log
+    #
+    # Each insert and delete is applied in memory and appended to the log, so that saving a change 
+    # costs the size of the change. The log is folded into the database file by writing a snapshot 
+    # of the database to a temporary file and renaming it over the database file, which is atomic, 
+    # so a crash leaves either the previous or the new database file.
+    #
+    # When folding, the log is first renamed to the old log (log + '.old'), and new changes go to a 
+    # new log. Records carry increasing sequence numbers, and the database file the sequence number 
+    # of its last change, so that replaying both logs on open (see open_database) only applies the 
+    # changes missing from the database file, wherever folding stopped.
+
+    def init_log(self):
+        self.lock = threading.Lock()
+        self.compacting = threading.Lock()
+        self.wal = None
+
+    @property
+    def log_filename(self):
+        # In-memory databases (e.g. for evaluation) aren't logged
+        if self.filename == os.devnull:
+            return None
+
+        return self.filename + WAL_EXTENSION
+
+    def log(self, operation, key, value=None):
+        """
+        Appends a change to the log. Must be called with the lock held.
+        """
+        self.sequence += 1
+
+        if self.log_filename is None:
+            return
+
+        blob = pickle.dumps((operation, key, value))
+        header = np.array([(self.sequence, len(blob), zlib.crc32(blob))], dtype=WAL_HEADER)
+
+        if self.wal is None:
+            self.wal = open(self.log_filename, 'ab')
+
+        self.wal.write(header.tobytes() + blob)
+        self.wal.flush()
+
+        if WAL_SYNC:
+            os.fsync(self.wal.fileno())
+
+    def replay(self):
+        """
+        Applies the changes of the (old and current) logs missing from the database, 
+        and drops any record left partially written by a crash.
+        """
+        if self.log_filename is None:
+            return
+
+        old = self.log_filename + '.old'
+        changes = 0
+
+        for filename in (old, self.log_filename):
+            records, end = read_log(filename)
+
+            for sequence, (operation, key, value) in records:
+                if sequence <= self.sequence:
+                    continue
+
+                if operation == 'insert':
+                    self.kv[key].append(value)
+                else:
+                    self.kv.pop(key, None)
+
+                self.sequence = sequence
+                changes += 1
+
+            if end is not None and filename == self.log_filename:
+                with open(filename, 'ab') as f:
+                    f.truncate(end)
+
+        if changes:
+            self.reindex()
+
+        # An interrupted fold is finished now, so that the old log isn't overwritten by the next one
+        if os.path.exists(old):
+            self.fold()
+        elif os.path.exists(self.log_filename) and os.path.getsize(self.log_filename) > WAL_COMPACT_SIZE:
+            self.compact_log()
+
+    def reindex(self):
+        """
+        Rebuilds the descriptor index from the keys of the database.
+        """
+        self.descriptors, self.kdtree = self.build_index()
+        self.delta, self.deleted = [], set()
+
+        self.cache.clear()
+        self.index_hashes()
+
+    def build_index(self):
+        """
+        Returns the descriptors of the database, and a new KD-tree of them.
+        """
+        descriptors = np.array([np.frombuffer(d, dtype=float) for d, gs in self.kv.items() if gs])
+        descriptors = descriptors.reshape(-1, self.descriptor_size)
+
+        return descriptors, type(self.kdtree)(self.normalize(descriptors))
+
+    def compact_log(self):
+        """
+        Folds the log into the database file in a background thread, if it is larger than WAL_COMPACT_SIZE 
+        and isn't already being folded.
+        """
+        with self.lock:
+            if self.wal is None or self.wal.tell() <= WAL_COMPACT_SIZE:
+                return
+
+        if self.compacting.locked():
+            return
+
+        threading.Thread(target=self.fold, daemon=True).start()
+
+    def fold(self):
+        """
+        Writes a snapshot of the database to the database file, and removes the log changes it contains.
+        The KD-tree is rebuilt with the descriptors inserted and deleted since it was built.
+        """
+        # In-memory databases have no log to fold, only the index
+        if self.log_filename is None:
+            with self.lock:
+                self.reindex()
+            return
+
+        with self.compacting:
+            with self.lock:
+                snapshot = self.snapshot()
+
+                # New changes go to a new log
+                if self.wal is not None:
+                    self.wal.close()
+                    self.wal = None
+
+                if os.path.exists(self.log_filename):
+                    os.replace(self.log_filename, self.log_filename + '.old')
+
+            if snapshot.delta or snapshot.deleted:
+                snapshot.descriptors, snapshot.kdtree = snapshot.build_index()
+                snapshot.delta, snapshot.deleted = [], set()
+
+            write_atomically(self.filename, pickle.dumps(snapshot))
+
+            if os.path.exists(self.log_filename + '.old'):
+                os.remove(self.log_filename + '.old')
+
+            if snapshot.kdtree is not self.kdtree:
+                self.adopt_index(snapshot.descriptors, snapshot.kdtree)
+
+    def adopt_index(self, descriptors, kdtree):
+        """
+        Replaces the KD-tree with one built while the database kept changing, 
+        keeping the changes since as the delta.
+        """
+        with self.lock:
+            indexed = set(bytes(d) for d in descriptors)
+
+            self.descriptors, self.kdtree = descriptors, kdtree
+            self.delta = [k for k, gs in self.kv.items() if gs and k not in indexed]
+            self.deleted = set(k for k in indexed if not self.kv.get(k))
+
+        self.cache.clear()
+
+    def snapshot(self):
+        """
+        Returns a copy of the database, sharing its graphs and index, to be saved while it changes.
+        """
+        snapshot = object.__new__(type(self))
+        snapshot.__dict__.update(self.__getstate__())
+        snapshot.kv = defaultdict(list, {k: list(gs) for k, gs in self.kv.items()})
+
+        return snapshot
+
+    def __getstate__(self):
+        # The result cache, representatives index and log are not saved
+        state = self.__dict__.copy()
+        for k in ('cache', 'representatives', 'lock', 'compacting', 'wal'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('normalization', None) # databases saved before normalizations
+        self.__dict__.setdefault('sequence', 0) # and before the write-ahead log
+        self.__dict__.setdefault('delta', [])
+        self.__dict__.setdefault('deleted', set())
+        self.cache = QueryCache()
+        self.index_hashes()
+        self.init_log()
+
+class QueryCache:
+    """
+    A bounded LRU cache of query results, keyed by the quantized query descriptor and (K, topK).
+    """
+
+    def __init__(self, maxsize=QUERY_CACHE_SIZE, quantum=QUERY_CACHE_QUANTUM):
+        self.results = LRUCache(maxsize=maxsize) if maxsize > 0 else None
+        self.quantum = quantum
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, d, K, topK):
+        return (np.round(d / self.quantum).astype(np.int64).tobytes(), K, topK)
+
+    def get(self, key):
+        with self.lock:
+            result = None if self.results is None else self.results.get(key)
+
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            return result
+
+    def put(self, key, result):
+        if self.results is not None:
+            with self.lock:
+                self.results[key] = result
+
+    def clear(self):
+        if self.results is not None:
+            with self.lock:
+                self.results.clear()
+
+    def stats(self):
+        """
+        Returns the hit/miss counts, hit rate and size of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+            'size': 0 if self.results is None else len(self.results),
+        }
     
 def open_database(filename=DATABASE_FILENAME) -> Database:
     """
     Create db, with key_size of 8 bytes (C double) times vector size, 
     Other parameters to be determined
+
+    Changes in the write-ahead log since the database file was saved are replayed.
     """
     with open(filename, 'rb') as f:
-        return pickle.load(f)
+        db = pickle.load(f)
+
+    db.replay()
+
+    return db
 
 def query_database(db, query, K=50, top=5):
     """
     Returns the label from the database using a query graph.
     """
-    return db.query(query, K=K, top=top)
+    return db.query(query, K=K, topK=top)
+
+def rank_labels(neighbors):
+    """
+    Ranks the labels of the neighbor graphs returned by a query, most frequent first, 
+    counting the graphs each representative stands for.
+    Ties keep the order of the neighbors, which is by distance.
+    """
+    counts = Counter()
+    for g in neighbors:
+        counts.update(label_counts(g))
+
+    return counts.most_common()
 
 def close_database(db):
     """
@@ -109,6 +580,443 @@ def close_database(db):
     """
     db.close()
 
+def read_log(filename):
+    """
+    Returns the (sequence, (operation, key, value)) records of a write-ahead log, and the end of its 
+    last complete record if a partially written record follows it (else None).
+    """
+    try:
+        with open(filename, 'rb') as f:
+            buffer = f.read()
+    except FileNotFoundError:
+        return [], None
+
+    records = []
+    offset = 0
+
+    while offset < len(buffer):
+        end = offset + WAL_HEADER.itemsize
+        if end > len(buffer):
+            return records, offset
+
+        sequence, size, crc = np.frombuffer(buffer, dtype=WAL_HEADER, count=1, offset=offset)[0]
+
+        blob = buffer[end:end + size]
+        if len(blob) < size or zlib.crc32(blob) != crc:
+            return records, offset
+
+        records.append((int(sequence), pickle.loads(blob)))
+        offset = end + size
+
+    return records, None
+
+def write_atomically(filename, data):
+    """
+    Writes data to a temporary file, then renames it over the file, so that the file is never partially written.
+    """
+    tmp = filename + '.tmp'
+
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp, filename)
+
+
+class BruteForceIndex:
+    """
+    Exact nearest neighbor index by exhaustive search, with the query interface of a KD-tree.
+    Faster than a KD-tree for small databases or high-dimensional descriptors.
+    """
+
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=float)
+
+    def query(self, x, k=1):
+        x = np.asarray(x, dtype=float)
+        single = x.ndim == 1
+
+        X = np.atleast_2d(x)
+        distances = np.sqrt(((X[:, None, :] - self.data[None, :, :])**2).sum(axis=2))
+
+        n = len(self.data)
+        kk = min(k, n)
+
+        # Partial sort, then sort the k nearest
+        indeces = np.argpartition(distances, kk - 1, axis=1)[:, :kk]
+        order = np.take_along_axis(distances, indeces, axis=1).argsort(axis=1)
+        indeces = np.take_along_axis(indeces, order, axis=1)
+        distances = np.take_along_axis(distances, indeces, axis=1)
+
+        # Missing neighbors are reported like a KD-tree: infinite distance, index n
+        if k > n:
+            distances = np.pad(distances, ((0, 0), (0, k - n)), constant_values=np.inf)
+            indeces = np.pad(indeces, ((0, 0), (0, k - n)), constant_values=n)
+
+        if k == 1:
+            distances, indeces = distances[:, 0], indeces[:, 0]
+
+        if single:
+            return distances[0], indeces[0]
+
+        return distances, indeces
+
+INDEXES = {'kdtree': KDTree, 'brute': BruteForceIndex}
+
+"""
+------------------------------
+-- Shared database
+-- (multi-process serving)
+------------------------------
+"""
+
+class SharedDatabase(Database):
+    """
+    A read-only database whose descriptors and features live in a memory-mapped file, 
+    so that any number of processes can attach to it while sharing the same pages in memory.
+
+    The file contains a header (number of descriptors, descriptor size, features size), 
+    the descriptor matrix, the offsets of each descriptor's features, the pickled features, 
+    and the pickled normalization and representatives index (see collapse), 
+    which maps topology hashes to the (descriptor index, position) of representatives.
+    Each process only builds its own KD-tree over the shared descriptors, and unpickles 
+    the features of the neighbors it returns.
+
+    Pickling a shared database (e.g. to send it to a worker process) attaches to the same file.
+    """
+
+    HEADER_SIZE = 3
+
+    def __init__(self, filename=SHARED_DATABASE_FILENAME):
+        """
+        Attaches to the shared database file.
+        """
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        n, N, size = map(int, np.frombuffer(self.mm, dtype=np.int64, count=self.HEADER_SIZE))
+
+        # E.g. a pickled database, whose first bytes aren't a header
+        if min(n, N, size) < 0 or self.HEADER_SIZE*8 + n*N*8 + (n + 1)*8 + size > len(self.mm):
+            self.mm.close()
+            raise ValueError(f"{filename} is not a shared database file, see share_database.")
+
+        offset = self.HEADER_SIZE*8
+        self.descriptors = np.frombuffer(self.mm, dtype=np.float64, count=n*N, offset=offset).reshape(n, N)
+
+        offset += n*N*8
+        self.offsets = np.frombuffer(self.mm, dtype=np.int64, count=n + 1, offset=offset)
+
+        offset += (n + 1)*8
+        self.blob = memoryview(self.mm)[offset:offset + size]
+
+        offset += size
+        extra = pickle.loads(self.mm[offset:]) if offset < len(self.mm) else {}
+
+        # Files written before the representatives index only stored a normalization
+        if not isinstance(extra, dict):
+            extra = {'normalization': extra}
+
+        self.normalization = extra.get('normalization')
+
+        self.kdtree = KDTree(self.normalize(self.descriptors))
+
+        self.cache = QueryCache()
+
+        # Features are only unpickled when returned, so representatives are indexed by location
+        self.representatives = extra.get('representatives', {})
+
+        # Read-only, so always fully indexed
+        self.delta, self.deleted = [], set()
+
+    def features(self, i):
+        return pickle.loads(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def representative(self, h):
+        location = self.representatives.get(h)
+        if location is None:
+            return None
+
+        i, j = location
+        return self.features(i)[j]
+
+    def __reduce__(self):
+        return (SharedDatabase, (self.filename,))
+
+    def close(self):
+        """
+        Detaches from the shared database file.
+        """
+        # Views must be released before the mapping is closed
+        del self.descriptors, self.offsets, self.kdtree
+        self.blob.release()
+
+        self.mm.close()
+
+    def checkpoint(self):
+        raise TypeError("Shared databases are read-only.")
+
+    def insert(self, k: np.array, v):
+        raise TypeError("Shared databases are read-only.")
+
+    def delete(self, k: np.array):
+        raise TypeError("Shared databases are read-only.")
+
+def share_database(db, filename=SHARED_DATABASE_FILENAME) -> SharedDatabase:
+    """
+    Writes a database to a shared database file, and attaches to it.
+    Other processes attach to it with attach_database(filename).
+    """
+    features = [db.features(i) for i in range(len(db.descriptors))]
+    blobs = [pickle.dumps(gs) for gs in features]
+
+    representatives = {g.hash: (i, j) for i, gs in enumerate(features) for j, g in enumerate(gs) 
+                       if getattr(g, 'hash', None) is not None}
+
+    n, N = db.descriptors.shape
+    offsets = np.cumsum([0] + [len(b) for b in blobs], dtype=np.int64)
+
+    # Write to a temporary file first, so attached processes never see a partial file
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(np.array([n, N, offsets[-1]], dtype=np.int64).tobytes())
+        f.write(np.ascontiguousarray(db.descriptors, dtype=np.float64).tobytes())
+        f.write(offsets.tobytes())
+        for b in blobs:
+            f.write(b)
+        f.write(pickle.dumps({'normalization': db.normalization, 'representatives': representatives}))
+
+    os.replace(tmp, filename)
+
+    return SharedDatabase(filename)
+
+def attach_database(filename=SHARED_DATABASE_FILENAME) -> SharedDatabase:
+    """
+    Attaches to a shared database file written by share_database.
+    """
+    return SharedDatabase(filename)
+
+"""
+------------------------------
+-- Sharded database
+-- (partitioned by label)
+------------------------------
+"""
+
+class ShardedDatabase(Database):
+    """
+    A database split into shards, each a database with its own descriptor index and file.
+
+    Queries fan out to every shard in parallel, and the nearest descriptors of all shards 
+    are merged by distance. Shards are saved to and loaded from their own files, so that 
+    a shard can be rebuilt without touching the others (see rebuild_shard).
+
+    The database file itself only stores the shard file names, and opening it with 
+    open_database loads the shards.
+    """
+
+    def __init__(self, shards, filename=DATABASE_FILENAME, by='label'):
+        self.filename = filename
+        self.shards = shards
+        self.by = by
+
+        self.pool = ThreadPoolExecutor(max_workers=len(shards))
+
+        self.cache = QueryCache()
+
+    @property
+    def descriptor_size(self):
+        return self.shards[0].descriptor_size
+
+    def exact_match(self, query_graph):
+        for shard in self.shards:
+            g = shard.exact_match(query_graph)
+            if g is not None:
+                return g
+
+        return None
+
+    def lookup(self, keys, K=50, topK=100):
+        cache_keys = [self.cache.key(k, K, topK) for k in keys]
+
+        results = [self.cache.get(c) for c in cache_keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+
+        if missing:
+            # Query every shard in parallel
+            nearest = list(self.pool.map(lambda shard: shard.nearest(keys[missing], K), self.shards))
+
+            for j, i in enumerate(missing):
+                # K-way merge of the nearest descriptors of each shard, by distance
+                merged = heapq.merge(*[[(d, s, k) for d, k in n[j]] for s, n in enumerate(nearest)])
+
+                results[i] = self.neighbors(self.first(merged, K), topK)
+                self.cache.put(cache_keys[i], results[i])
+
+        # Copy, so that callers can't modify cached results
+        return [list(r) for r in results]
+
+    def first(self, merged, K):
+        """
+        Takes the merged (distance, shard, index) nearest descriptors up to the K-th distinct descriptor, 
+        as a descriptor can be in several shards (with graphs of different labels).
+        """
+        nearest = []
+        seen = set()
+
+        for d, s, i in merged:
+            key = self.shards[s].key(i)
+
+            if key not in seen:
+                if len(seen) == K:
+                    break
+                seen.add(key)
+
+            nearest.append((d, s, i))
+
+        return nearest
+
+    def neighbors(self, nearest, topK=100):
+        """
+        Gets the features of the (distance, shard, index) nearest descriptors, up to topK of them.
+        """
+        neighbors = []
+
+        for _, s, i in nearest:
+            if len(neighbors) >= topK:
+                break
+
+            neighbors += self.shards[s].features(i)[:topK - len(neighbors)]
+
+        return neighbors
+
+    def shard(self, label):
+        """
+        Gets the index of the shard of a label.
+        """
+        return shard_of(label, len(self.shards), self.by)
+
+    def checkpoint(self):
+        """
+        Saves every shard, and the shard file names, to disk.
+        """
+        for shard in self.shards:
+            shard.checkpoint()
+
+        write_atomically(self.filename, pickle.dumps(self))
+
+    def close(self):
+        self.pool.shutdown()
+
+        for shard in self.shards:
+            shard.close()
+
+    def replay(self):
+        # Each shard replays its own log when it is opened
+        pass
+
+    def insert(self, k: np.array, v):
+        self.shards[self.shard(v.graph['label'])].insert(k, v)
+        self.cache.clear()
+
+    def delete(self, k: np.array):
+        for shard in self.shards:
+            if bytes(k) in shard.kv:
+                shard.delete(k)
+        self.cache.clear()
+
+    def __getstate__(self):
+        # Shards are saved to their own files
+        return {'filename': self.filename, 'by': self.by, 
+                'shards': [shard.filename for shard in self.shards]}
+
+    def __setstate__(self, state):
+        shards = [open_database(f) for f in state['shards']]
+        self.__init__(shards, state['filename'], state['by'])
+
+def shard_of(label, n, by='label'):
+    """
+    Gets the index of the shard of a label, out of n shards.
+
+    By label, LABELS are dealt to the shards in turn, and other labels are hashed.
+    By hash, labels are spread by a stable hash.
+    """
+    if by == 'label' and label in LABELS:
+        return LABELS.index(label) % n
+
+    return zlib.crc32(str(label).encode()) % n
+
+def shard_filename(filename, i):
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{i}{ext}"
+
+def construct_sharded_database(descriptors, features, shards, filename=DATABASE_FILENAME, by='label', 
+                               collapse_duplicates=True, normalization='none'):
+    """
+    Populates a sharded database, partitioning the graphs by label (or hash of label) into shards.
+    Graphs with the same topology are collapsed into a representative (sharded by its most common label), 
+    if collapse_duplicates.
+
+    The normalization is fitted to the descriptors of all shards, so that their distances can be merged.
+    """
+    if collapse_duplicates:
+        descriptors, features = unzip(collapse(descriptors, features))
+    else:
+        descriptors, features = list(descriptors), list(features)
+
+    kvs = partition(descriptors, features, shards, by)
+    normalization = fit_normalization(descriptors, normalization)
+
+    db = ShardedDatabase([Database(kv, shard_filename(filename, i), normalization=normalization) 
+                          for i, kv in enumerate(kvs)], filename, by)
+
+    # Flush to disk
+    db.checkpoint()
+
+    return db
+
+def partition(descriptors, features, shards, by='label'):
+    """
+    Partitions the graphs into the base dictionaries of each shard.
+    """
+    kvs = [defaultdict(list) for _ in range(shards)]
+
+    for k, v in zip(descriptors, features):
+        kvs[shard_of(v.graph['label'], shards, by)][bytes(k)].append(compact(v))
+
+    # Empty shards can't be indexed
+    if not all(kvs):
+        raise ValueError("Every shard needs at least one graph, use fewer shards.")
+
+    return kvs
+
+def rebuild_shard(db, i, descriptors, features, collapse_duplicates=True):
+    """
+    Rebuilds the i-th shard of a sharded database from the graphs of its labels, 
+    and saves only that shard. The shard keeps the normalization of the database.
+    """
+    if collapse_duplicates:
+        descriptors, features = unzip(collapse(descriptors, features))
+
+    kv = defaultdict(list)
+
+    for k, v in zip(descriptors, features):
+        if db.shard(v.graph['label']) == i:
+            kv[bytes(k)].append(compact(v))
+
+    shard = Database(kv, db.shards[i].filename, normalization=db.shards[i].normalization)
+
+    # The new shard file replaces the old shard's file and log
+    db.shards[i].close()
+    shard.checkpoint()
+
+    db.shards[i] = shard
+    db.cache.clear()
+
+    return shard
 
 """
 ------------------------------
@@ -117,21 +1025,30 @@ def close_database(db):
 ------------------------------
 """
 
-def construct_database(descriptors, features):
+def construct_database(descriptors, features, filename=DATABASE_FILENAME, collapse_duplicates=True, 
+                       normalization='none'):
     """
     Populates database with all graphs extracted from images, using graph descriptors as keys.
+    Graphs are stored as compact graphs (see src.graph), and graphs with the same topology 
+    are collapsed into a representative, if collapse_duplicates.
+
+    The KD-tree indexes the descriptors normalized with the given normalization (see NORMALIZATIONS),
+    fitted to them, and stored with the database.
     
     Uses the algorithms described in Fonseca and Jorge "Indexing High-Dimensional Data for 
     Content-Based Retrieval in Large Databases".
     """
+    if collapse_duplicates:
+        descriptors, features = unzip(collapse(descriptors, features))
+
     # Create base dictionary
     kv = defaultdict(list)
 
     for k, v in zip(descriptors, features):
-        kv[bytes(k)].append(v)
+        kv[bytes(k)].append(compact(v))
 
     # Create new Database    
-    db =  Database(kv) 
+    db =  Database(kv, filename, normalization=fit_normalization(list(kv), normalization)) 
 
     # Flush to disk
     db.checkpoint()
@@ -139,12 +1056,20 @@ def construct_database(descriptors, features):
     return db
         
 
+def unzip(pairs):
+    """
+    Splits (descriptor, graph) pairs into lists of descriptors and graphs.
+    """
+    pairs = list(pairs)
+    return [d for d, _ in pairs], [g for _, g in pairs]
+
 """
 ------------------------------
 -- Database keys (descriptor)
 ------------------------------
 """
 
+@staged('descriptor', lambda d, graph, *args, **kwargs: {'nodes': graph.number_of_nodes()})
 def descriptor(graph, N=DESCRIPTOR_SIZE):
     """
     Get the topology descriptor of the graph, as described in 
@@ -160,10 +1085,11 @@ def descriptor(graph, N=DESCRIPTOR_SIZE):
     
     It is padded with zeroes to a certain max length if the descriptor is less than.
     
-    This N is calculated as either a max or, more flexibly, as a percentile (99.9%, for example).
+    This N is calculated as either a max or, more flexibly, as a percentile (99.9%, for example), 
+    see src.tuning.
     """
     # Get adjacency matrix of graph
-    A = nx.to_numpy_array(graph)
+    A = adjacency_matrix(graph)
     
     if A.size == 0:
         return np.zeros(N)
@@ -179,3 +1105,71 @@ def descriptor(graph, N=DESCRIPTOR_SIZE):
     else:
         # Truncate
         return spectra[:N]
+
+
+class Normalization:
+    """
+    An affine transform of descriptors, (d - mean) @ transform, fitted to the descriptors of a database:
+
+    - scale:  each dimension to unit variance
+    - whiten: to uncorrelated dimensions of unit variance
+    - pca:    rotated to the principal components that keep PCA_VARIANCE of the variance
+
+    Dimensions without variance (e.g. always padded) are dropped by whiten and pca, and unscaled by scale.
+    """
+
+    def __init__(self, kind, mean, transform):
+        self.kind = kind
+        self.mean = mean
+        self.transform = transform
+
+    @classmethod
+    def fit(cls, descriptors, kind='scale', variance=PCA_VARIANCE):
+        X = np.asarray(descriptors, dtype=float)
+        mean = X.mean(axis=0)
+
+        if kind == 'scale':
+            std = X.std(axis=0)
+            std[std**2 <= MIN_VARIANCE*max(std.max()**2, MIN_VARIANCE)] = 1
+
+            return cls(kind, mean, np.diag(1/std))
+
+        # Principal components, largest variance first
+        w, V = np.linalg.eigh(np.cov(X, rowvar=False).reshape(X.shape[1], X.shape[1]))
+        w, V = w[::-1], V[:, ::-1]
+
+        n = max(1, int((w > MIN_VARIANCE*max(w[0], MIN_VARIANCE)).sum()))
+
+        if kind == 'whiten':
+            return cls(kind, mean, V[:, :n] / np.sqrt(w[:n]))
+
+        if kind == 'pca':
+            explained = np.cumsum(w[:n]) / max(w[:n].sum(), MIN_VARIANCE)
+            n = min(n, int(np.searchsorted(explained, variance)) + 1)
+
+            return cls(kind, mean, V[:, :n])
+
+        raise ValueError(f"Unknown normalization {kind!r}, expected one of {NORMALIZATIONS}.")
+
+    @property
+    def size(self):
+        """
+        The number of dimensions of normalized descriptors.
+        """
+        return self.transform.shape[1]
+
+    def __call__(self, keys):
+        return (np.asarray(keys, dtype=float) - self.mean) @ self.transform
+
+    def __repr__(self):
+        return f"Normalization({self.kind!r}, {self.mean.size} -> {self.size})"
+
+def fit_normalization(descriptors, kind='none'):
+    """
+    Fits a normalization of the given kind to the descriptors (or keys), or returns None for 'none'.
+    """
+    if kind is None or kind == 'none':
+        return None
+
+    return Normalization.fit([np.frombuffer(d, dtype=float) if isinstance(d, bytes) else d 
+                              for d in descriptors], kind)
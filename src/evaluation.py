@@ -0,0 +1,302 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import product
+
+from src.svg import load, to_control_points
+from src.extraction import extract_graph, get_line_strings
+from src.database import Database, ShardedDatabase, INDEXES, NORMALIZATIONS, descriptor, fit_normalization, partition, unzip, rank_labels, DESCRIPTOR_SIZE
+from src.labels import LABELS
+from src.cache import ExtractionCache
+from src.corpus import CorpusWriter, read_corpus
+from src.graph import collapse
+
+"""
+Retrieval quality and latency evaluation.
+
+Splits the labelled SVG sketches into train and test sets, builds a database from
+the train set for each retrieval configuration, and reports top-1/top-5 accuracy
+per label next to query latency percentiles and throughput:
+
+    python -m src.evaluation --K 10 50 --topK 20 100 --descriptor-size 5 7 --index kdtree brute
+"""
+
+IMAGE_DIRECTORY = os.sep.join(['assets', 'svg'])
+
+TEST_FRACTION = 0.2
+
+STEP = 20
+
+"""
+----------------------------
+-- DATASET
+----------------------------
+"""
+
+def load_svg_files(directory=IMAGE_DIRECTORY, ext='svg'):
+    """
+    Returns the (file path, label) pairs of all images, labelled by their directory.
+    """
+    files = []
+
+    for r, _, f in os.walk(directory):
+        for file in sorted(f):
+            if file.endswith(f'.{ext}'):
+                files.append((os.path.join(r, file), os.path.basename(r)))
+
+    return files
+
+def split(files, test_fraction=TEST_FRACTION, limit=None, seed=0):
+    """
+    Splits the files into train and test sets, stratified by label.
+    At most limit files are used per label, if given.
+    """
+    rng = np.random.default_rng(seed)
+
+    by_label = defaultdict(list)
+    for f, l in files:
+        by_label[l].append((f, l))
+
+    train, test = [], []
+    for l in sorted(by_label):
+        fs = [by_label[l][i] for i in rng.permutation(len(by_label[l]))][:limit]
+
+        n = max(1, round(len(fs)*test_fraction)) if len(fs) > 1 else 0
+
+        test  += fs[:n]
+        train += fs[n:]
+
+    return train, test
+
+# Extraction caches of each worker process, by directory
+CACHES = {}
+
+def extract_file(file, cache=None):
+    """
+    Extracts the graph of a labelled svg file, or None if it can't be extracted.
+    Graphs are cached on disk in the cache directory, if given.
+    """
+    filename, l = file
+    try:
+        svg = load(filename)
+        line_strings = get_line_strings(map(to_control_points, svg['paths']), step=STEP)
+
+        if cache is None:
+            return extract_graph(line_strings, l, step=STEP, check_area=False)
+
+        if cache not in CACHES:
+            CACHES[cache] = ExtractionCache(directory=cache)
+
+        graph, _ = CACHES[cache].extract(line_strings, l, step=STEP)
+        return graph
+    except Exception:
+        return None
+
+def extract_files(files, workers=None, cache=None):
+    """
+    Extracts the graphs of the labelled files in a process pool, skipping the ones that fail.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        graphs = executor.map(partial(extract_file, cache=cache), files, chunksize=16)
+        return [g for g in graphs if g is not None]
+
+def extract_corpus(files, filename, workers=None, cache=None):
+    """
+    Extracts the graphs of the labelled files into a corpus, writing them as they are extracted.
+    Files already in the corpus are skipped, so that an interrupted extraction resumes where it stopped.
+    """
+    done = set(r.source for r in read_corpus(filename)) if os.path.exists(filename) else set()
+    files = [f for f in files if f[0] not in done]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, CorpusWriter(filename) as corpus:
+        graphs = executor.map(partial(extract_file, cache=cache), files, chunksize=16)
+
+        for (source, l), g in zip(files, graphs):
+            if g is not None:
+                corpus.write(g, descriptor(g), l, source)
+
+def load_corpus(files, filename):
+    """
+    Reads the graphs of the labelled files from a corpus, skipping the ones it doesn't have.
+    """
+    sources = set(f for f, _ in files)
+    graphs = {r.source: r.graph for r in read_corpus(filename) if r.source in sources}
+
+    return [graphs[f] for f, _ in files if f in graphs]
+
+"""
+----------------------------
+-- EVALUATION
+----------------------------
+"""
+
+def build(graphs, descriptor_size=DESCRIPTOR_SIZE, index='kdtree', shards=1, collapse_duplicates=False, 
+          normalization='none'):
+    """
+    Builds an in-memory database of graphs, sharded by label if shards > 1, 
+    with graphs of the same topology collapsed if collapse_duplicates, 
+    and descriptors normalized with the given normalization (see database.Normalization).
+    """
+    descriptors = [descriptor(g, N=descriptor_size) for g in graphs]
+
+    if collapse_duplicates:
+        descriptors, graphs = unzip(collapse(descriptors, graphs))
+
+    kvs = partition(descriptors, graphs, shards)
+    normalization = fit_normalization(descriptors, normalization)
+
+    if shards == 1:
+        return Database(kvs[0], filename=os.devnull, index=INDEXES[index], normalization=normalization)
+
+    return ShardedDatabase([Database(kv, filename=os.devnull, index=INDEXES[index], normalization=normalization) 
+                            for kv in kvs], filename=os.devnull)
+
+def evaluate(db, test, K=50, topK=100):
+    """
+    Queries the database with each test graph, and returns the accuracy and latency metrics.
+    Queries with an exact topology match in the database (see collapse) only return that match.
+    """
+    # Latency of single queries
+    latencies = []
+    results = []
+    exact = 0
+    for g in test:
+        start = time.perf_counter()
+
+        match = db.exact_match(g)
+        if match is not None:
+            results.append([match])
+            exact += 1
+        else:
+            results.append(db.query(g, K=K, topK=topK))
+
+        latencies.append(time.perf_counter() - start)
+
+    # Throughput of batched queries
+    start = time.perf_counter()
+    db.query_batch(test, K=K, topK=topK)
+    throughput = len(test) / (time.perf_counter() - start)
+
+    top1 = defaultdict(list)
+    top5 = defaultdict(list)
+    for g, neighbors in zip(test, results):
+        ranked = [l for l, _ in rank_labels(neighbors)]
+        l = g.graph['label']
+
+        top1[l].append(ranked[:1] == [l])
+        top5[l].append(l in ranked[:5])
+
+    latencies = np.array(latencies)*1000
+
+    return {
+        'top1': float(np.mean(sum(top1.values(), []))),
+        'top5': float(np.mean(sum(top5.values(), []))),
+        'p50': float(np.percentile(latencies, 50)),
+        'p95': float(np.percentile(latencies, 95)),
+        'p99': float(np.percentile(latencies, 99)),
+        'throughput': throughput,
+        'exact': exact / len(test),
+        'labels': {l: {'top1': float(np.mean(top1[l])), 'top5': float(np.mean(top5[l])), 'n': len(top1[l])}
+                   for l in LABELS if l in top1},
+    }
+
+def run(train, test, Ks=(50,), topKs=(100,), descriptor_sizes=(DESCRIPTOR_SIZE,), indexes=('kdtree',), shards=1, 
+        collapse_duplicates=False, normalizations=('none',)):
+    """
+    Evaluates every retrieval configuration, returning a list of configurations and their metrics.
+    """
+    results = []
+
+    for N, index, normalization in product(descriptor_sizes, indexes, normalizations):
+        start = time.perf_counter()
+        db = build(train, descriptor_size=N, index=index, shards=shards, collapse_duplicates=collapse_duplicates, 
+                   normalization=normalization)
+        build_time = time.perf_counter() - start
+
+        for K, topK in product(Ks, topKs):
+            metrics = evaluate(db, test, K=K, topK=topK)
+            metrics['build'] = build_time
+
+            config = {'K': K, 'topK': topK, 'descriptor_size': N, 'index': index, 'normalization': normalization}
+            results.append({'config': config, 'metrics': metrics})
+
+            print(format_row(config, metrics))
+
+    return results
+
+def format_row(config, metrics):
+    return (f"K={config['K']:<4} topK={config['topK']:<4} N={config['descriptor_size']:<3} "
+            f"index={config['index']:<7} norm={config['normalization']:<6} | top1={metrics['top1']:.3f} top5={metrics['top5']:.3f} | "
+            f"p50={metrics['p50']:.2f} p95={metrics['p95']:.2f} p99={metrics['p99']:.2f} ms "
+            f"throughput={metrics['throughput']:.0f} q/s exact={metrics['exact']:.2f}")
+
+def print_labels(result):
+    """
+    Prints the per label accuracy of an evaluation result.
+    """
+    for l, m in result['metrics']['labels'].items():
+        print(f"{l:>20}: top1={m['top1']:.2f} top5={m['top5']:.2f} (n={m['n']})")
+
+"""
+----------------------------
+-- RUNNER
+----------------------------
+"""
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Evaluate retrieval quality and latency.")
+    parser.add_argument('--directory', default=IMAGE_DIRECTORY)
+    parser.add_argument('--test-fraction', type=float, default=TEST_FRACTION)
+    parser.add_argument('--limit', type=int, default=None, help="max files per label")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache', default=None, help="directory to cache extracted graphs in")
+    parser.add_argument('--corpus', default=None, help="corpus file to store extracted graphs in, and read them from")
+    parser.add_argument('--K', type=int, nargs='+', default=[50])
+    parser.add_argument('--topK', type=int, nargs='+', default=[100])
+    parser.add_argument('--descriptor-size', type=int, nargs='+', default=[DESCRIPTOR_SIZE])
+    parser.add_argument('--index', nargs='+', default=['kdtree'], choices=list(INDEXES))
+    parser.add_argument('--normalization', nargs='+', default=['none'], choices=NORMALIZATIONS)
+    parser.add_argument('--shards', type=int, default=1, help="number of label shards of the database")
+    parser.add_argument('--collapse', action='store_true', help="collapse graphs with the same topology")
+    parser.add_argument('--labels', action='store_true', help="print per label accuracy")
+    parser.add_argument('--output', default=None, help="file to store the results in, as JSON")
+
+    args = parser.parse_args()
+
+    train, test = split(load_svg_files(args.directory), args.test_fraction, args.limit, args.seed)
+
+    if args.corpus is not None:
+        extract_corpus(train + test, args.corpus, args.workers, args.cache)
+
+        train = load_corpus(train, args.corpus)
+        test  = load_corpus(test, args.corpus)
+    else:
+        train = extract_files(train, args.workers, args.cache)
+        test  = extract_files(test, args.workers, args.cache)
+
+    print(f"train={len(train)} test={len(test)} graphs")
+
+    results = run(train, test, args.K, args.topK, args.descriptor_size, args.index, args.shards, args.collapse, 
+                  args.normalization)
+
+    if args.labels:
+        for r in results:
+            print(format_row(r['config'], r['metrics']))
+            print_labels(r)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,23 @@
 import networkx as nx
 
-import matplotlib.pyplot as plt
+# matplotlib is imported on first use by the plotting functions, as it is slow to import
 
 import shapely
 
 from itertools import product, combinations
 
-from numpy import array
+from numpy import array, asarray, empty, vstack, column_stack
+
+from src.instrumentation import stage, staged
+from src.graph import FEATURES
 
 DEFAULT_STEP = 20
 
+# Version of the extracted graphs (and their descriptors), hashed into extraction cache keys (see src.cache).
+# Bump it whenever their output changes, e.g. in node_attributes, get_polygons or database.descriptor:
+# 2: nodes store their number of vertices, 3: cycle bases don't depend on the order of strokes
+EXTRACTION_VERSION = 3
+
 """
 ----------------------------
 -- GRAPH EXTRACTION (on-line)
@@ -22,6 +30,7 @@ def label(graph):
     """
     return graph.graph['label']
 
+@staged('extract_graph', lambda G, *args, **kwargs: {'nodes': G.number_of_nodes(), 'edges': G.number_of_edges()})
 def extract_graph(line_strings, label, step=DEFAULT_STEP, check_area=True) -> nx.Graph:
     """
     Extract topology and geometry graph from source (image, label) pair.
@@ -45,9 +54,6 @@ def extract_graph(line_strings, label, step=DEFAULT_STEP, check_area=True) -> nx
     # detect polygons to use as vertices and for adjacency relations
     polygons = filter_polygons(get_polygons(line_strings), step=step)
 
-    # Use polygon centroids to get node
-    centroids = get_centroids(polygons)
-    
     # Create output graph
     G = nx.Graph()
 
@@ -58,35 +64,16 @@ def extract_graph(line_strings, label, step=DEFAULT_STEP, check_area=True) -> nx
     # - area  
     # - bounding box area
     # - bounding circle radius
-    for i, c in enumerate(centroids):
-        if polygons[i] is not None:
-            length = polygons[i].length
-            area   = polygons[i].area 
-
-            radius = shapely.minimum_bounding_radius(polygons[i])
-            
-            minx, miny, maxx, maxy = polygons[i].bounds
-            bounds = (maxx - minx)*(maxy - miny)
-            
-            num_vertices = (set(polygons[i].boundary.coords))
-            
-            G.add_node(i, 
-                       position=(c.x, c.y),
-                       vertices=num_vertices,
-                       length=length,
-                       area=area,
-                       radius=radius,
-                       bounds=bounds
-                      )
+    # measured at once, over the array of polygons
+    G.add_nodes_from(enumerate(node_attributes(node_measurements(polygons))))
     
     # Create neighbor edges using convex hull intersection
     for i, j in combinations(G.nodes, 2):
         h1, h2 = polygons[i], polygons[j]
         if i != j and h1 is not None and h2 is not None:
-            if h1.intersects(h2):
-                G.add_edge(i, j, relation='neighbor')
-            elif h1.contains(h2):
-                G.add_edge(i, j, relation='parent')
+            r = relation(h1, h2)
+            if r is not None:
+                G.add_edge(i, j, relation=r)
                 
     # Add graph labels
     G.graph['label'] = label
@@ -96,6 +83,210 @@ def extract_graph(line_strings, label, step=DEFAULT_STEP, check_area=True) -> nx
     
     return G
 
+def node_features(polygon):
+    """
+    Gets the features of the topology graph node of a polygon.
+    """
+    return node_attributes(node_measurements([polygon]))[0]
+
+def node_measurements(polygons):
+    """
+    Measures an array of polygons with shapely's vectorized functions, returning 
+    a feature matrix with a row per polygon, and a column per feature of FEATURES.
+    """
+    polygons = array(polygons, dtype=object)
+
+    if len(polygons) == 0:
+        return empty((0, len(FEATURES)))
+
+    centroids = shapely.centroid(polygons)
+
+    minx, miny, maxx, maxy = shapely.bounds(polygons).T
+
+    # Coordinates of each ring, without the closing coordinate repeating its first one
+    vertices = shapely.get_num_coordinates(polygons) - shapely.get_num_interior_rings(polygons) - 1
+
+    return column_stack([shapely.get_x(centroids),
+                         shapely.get_y(centroids),
+                         vertices,
+                         shapely.length(polygons),
+                         shapely.area(polygons),
+                         shapely.minimum_bounding_radius(polygons),
+                         (maxx - minx)*(maxy - miny)])
+
+def node_attributes(features):
+    """
+    Gets the topology graph node attributes of each row of a feature matrix.
+    """
+    return [dict(position=(x, y),
+                 vertices=int(vertices),
+                 length=length,
+                 area=area,
+                 radius=radius,
+                 bounds=bounds
+                )
+            for x, y, vertices, length, area, radius, bounds in features.tolist()]
+
+def relation(h1, h2):
+    """
+    Gets the spatial relation between two polygons, or None if they are unrelated.
+    """
+    if h1.intersects(h2):
+        return 'neighbor'
+    elif h1.contains(h2):
+        return 'parent'
+    
+    return None
+
+"""
+----------------------------
+-- INCREMENTAL GRAPH EXTRACTION (on-line)
+----------------------------
+"""
+
+class IncrementalExtractor:
+    """
+    Extracts the topology graph of a sketch one stroke at a time, as it is drawn.
+
+    Keeps the segments, planar graph, polygons and topology graph of the strokes 
+    added so far, and only processes what a new stroke changes:
+    - Only the new stroke's segments are intersected with the existing segments
+    - Only the cycles of the planar graph components touched by the stroke are recomputed
+    - Only the topology graph nodes of changed polygons are replaced
+
+    The results are the same as extract_graph(get_line_strings(paths), check_area=False), 
+    up to the order of nodes, as both choose cycles with minimum_cycle_basis.
+    """
+
+    def __init__(self, step=DEFAULT_STEP):
+        self.step = step
+        self.clear()
+
+    def clear(self):
+        """
+        Removes all strokes.
+        """
+        self.line_strings = []
+
+        # Segments and their bounds, for intersection candidates
+        self.segments = []
+        self.bounds = empty((0, 4))
+
+        # Graph induced by the non-intersecting line segments
+        self.planar = nx.Graph()
+
+        # Planar graph component (node set) -> (polygons, topology graph nodes)
+        self.components = {}
+
+        # Topology graph, and the polygon of each of its nodes
+        self.topology = nx.Graph()
+        self.shapes = {}
+        self.next_node = 0
+
+    @staged('add_stroke')
+    def add_stroke(self, path):
+        """
+        Adds a stroke (list of points) to the sketch, and updates its graphs.
+        """
+        if len(path) < 2:
+            return
+
+        ls = to_line_string(snap_round(path, self.step))
+        self.line_strings.append(ls)
+
+        new_segments = get_segments(detect_approximate_polygon(ls))
+        if not new_segments:
+            return
+
+        n = len(self.segments)
+
+        self.segments += new_segments
+        self.bounds = vstack([self.bounds, shapely.bounds(new_segments)])
+
+        # Intersect each new segment with the segments before it, 
+        # using bounding box overlaps to find candidates
+        touched = set()
+        for k, seg in enumerate(new_segments):
+            minx, miny, maxx, maxy = self.bounds[n + k]
+            previous = self.bounds[:n + k]
+
+            candidates = ((previous[:, 0] <= maxx) & (previous[:, 2] >= minx) & 
+                          (previous[:, 1] <= maxy) & (previous[:, 3] >= miny)).nonzero()[0]
+            
+            for i in candidates:
+                touched.update(add_intersection(self.planar, self.segments[i], seg))
+
+        if touched:
+            self.update_components(touched)
+
+    def update_components(self, touched):
+        """
+        Recomputes the polygons and topology graph nodes of the planar graph 
+        components containing the touched nodes.
+        """
+        # Remove the (now merged or grown) components containing touched nodes
+        for c in [c for c in self.components if not c.isdisjoint(touched)]:
+            _, nodes = self.components.pop(c)
+
+            self.topology.remove_nodes_from(nodes)
+            for i in nodes:
+                del self.shapes[i]
+
+        # Recompute cycles of the new components
+        seen = set()
+        for v in touched:
+            if v in seen:
+                continue
+
+            c = frozenset(nx.node_connected_component(self.planar, v))
+            seen |= c
+
+            with stage('minimum_cycle_basis', nodes=len(c)) as sizes:
+                cycles = minimum_cycle_basis(self.planar.subgraph(c))
+                sizes['cycles'] = len(cycles)
+
+            polygons = cycle_polygons(cycles)
+
+            nodes = self.add_nodes(filter_polygons(polygons, step=self.step))
+
+            self.components[c] = (polygons, nodes)
+
+    def add_nodes(self, polygons):
+        """
+        Adds the given polygons as topology graph nodes, related to all existing nodes.
+        """
+        nodes = []
+        for p, attribs in zip(polygons, node_attributes(node_measurements(polygons))):
+            i = self.next_node
+            self.next_node += 1
+
+            self.topology.add_node(i, **attribs)
+
+            for j, h in self.shapes.items():
+                r = relation(h, p)
+                if r is not None:
+                    self.topology.add_edge(j, i, relation=r)
+
+            self.shapes[i] = p
+            nodes.append(i)
+
+        return nodes
+
+    @property
+    def polygons(self):
+        """
+        The polygons of the sketch, as returned by get_polygons.
+        """
+        return [p for polygons, _ in self.components.values() for p in polygons]
+
+    def graph(self, label):
+        """
+        Returns a copy of the topology graph, as returned by extract_graph.
+        """
+        G = nx.convert_node_labels_to_integers(self.topology)
+        G.graph['label'] = label
+        return G
+
 """
 ----------------------------
 -- PLOTTING
@@ -106,6 +297,8 @@ def plot_graph(G, subtitle=''):
     """
     Plot extracted graph.
     """
+    import matplotlib.pyplot as plt
+
     pos = nx.get_node_attributes(G,'position')
     
     fig = plt.figure()
@@ -131,31 +324,38 @@ def plot_graph(G, subtitle=''):
     return fig
 
 def plot_polygons(polygons):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
     
     title = 'Polygons'
     plt.title(title)
 
-    for p in polygons:
-        if p is None:
-            continue
+    from matplotlib.collections import LineCollection
 
-        x,y = p.exterior.xy
-        plt.plot(x,y)
+    # A single collection, rather than a line per polygon
+    outlines = [p.exterior.coords for p in polygons if p is not None]
+    plt.gca().add_collection(LineCollection(outlines, colors=[f"C{i % 10}" for i in range(len(outlines))]))
+    plt.gca().autoscale()
 
     plt.gca().invert_yaxis()
 
     return fig
 
 def plot_line_strings(line_strings):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
     
     title = 'Line strings'
     plt.title(title)
 
-    for ls in line_strings:
-        x, y = ls.coords.xy
-        plt.plot(x, y)
+    from matplotlib.collections import LineCollection
+
+    # A single collection, rather than a line per line string
+    lines = [ls.coords for ls in line_strings]
+    plt.gca().add_collection(LineCollection(lines, colors=[f"C{i % 10}" for i in range(len(lines))]))
+    plt.gca().autoscale()
 
     plt.gca().invert_yaxis()
 
@@ -171,6 +371,7 @@ def plot_line_strings(line_strings):
 def is_big_enough(line_strings):
     return shapely.box(*shapely.MultiLineString(line_strings).bounds).area > 34_000
 
+@staged('get_line_strings', lambda ls, *args, **kwargs: {'line_strings': len(ls)})
 def get_line_strings(paths, step=DEFAULT_STEP):
     """
     Converts the paths (list of lists of points) to line strings.
@@ -190,7 +391,8 @@ def snap_round(path_points, step=DEFAULT_STEP):
     """
     The snap round algorithm: line segments to a fixed precision grid.
     """
-    return (array(path_points)//step)*step
+    # asarray, so that array paths aren't copied before rounding
+    return (asarray(path_points)//step)*step
 
 
 def to_line_string(path_points):
@@ -236,6 +438,7 @@ def filter_polygons(polygons, step=DEFAULT_STEP):
     """
     return [p for p in polygons if p is not None and p.area > (step**2)*4]
 
+@staged('get_polygons', lambda polygons, *args, **kwargs: {'polygons': len(polygons)})
 def get_polygons(line_strings):
     """
     Returns the polygons created by the list of line strings.
@@ -250,10 +453,6 @@ def get_polygons(line_strings):
 
     Uses the linestring intersection detection code from: https://gis.stackexchange.com/a/423405
     """
-    def add_edge_ifneq(g, a, b):
-        if a != b:
-            g.add_edge(a,b)
-            
     # Process "near-polygons" first
             
     segments = []
@@ -262,29 +461,93 @@ def get_polygons(line_strings):
         
     g = nx.Graph()
     
-    for seg1,seg2 in combinations(segments,2):
-        if seg1.intersects(seg2):
-            inter = seg1.intersection(seg2)
-            
-            s1, t1 = get_endpoints(seg1)
-            s2, t2 = get_endpoints(seg2)
+    with stage('intersections', segments=len(segments)) as sizes:
+        intersections = 0
+        for seg1,seg2 in combinations(segments,2):
+            intersections += bool(add_intersection(g, seg1, seg2))
 
-            if isinstance(inter, shapely.Point):  
-                g.add_nodes_from([s1, s2, t1, t2, inter])
-                
-                add_edge_ifneq(g, s1, inter)
-                add_edge_ifneq(g, s2, inter)
-                add_edge_ifneq(g, inter, t1)
-                add_edge_ifneq(g, inter, t2)
-            else:
-                i1, i2 = inter.coords
-                
-                g.add_nodes_from([s1, s2, t1, t2, i1, i2])
-                
-                # idk about edges in this case :(
+        sizes['intersections'] = intersections
             
-    cycles = nx.minimum_cycle_basis(g)
+    with stage('minimum_cycle_basis', nodes=g.number_of_nodes(), edges=g.number_of_edges()) as sizes:
+        cycles = minimum_cycle_basis(g)
+        sizes['cycles'] = len(cycles)
+
+    return cycle_polygons(cycles)
+
+def minimum_cycle_basis(g):
+    """
+    Computes the Minimum Cycle Basis of the graph induced by the line segments, as lists of points.
+
+    Among equally minimal bases, networkx's choice depends on the order of nodes and edges, 
+    and on the hashes of the nodes. So each connected component is renumbered in coordinate order 
+    first, making the basis depend only on the component, and not on how the graph was built 
+    (e.g. incrementally) or on the hashes of points.
+    """
+    cycles = []
+
+    for c in nx.connected_components(g):
+        points = sorted(c, key=point_order)
+        index = {p: i for i, p in enumerate(points)}
+
+        h = nx.Graph()
+        h.add_nodes_from(range(len(points)))
+        h.add_edges_from(sorted(tuple(sorted((index[u], index[v]))) for u, v in g.subgraph(c).edges))
+
+        cycles += [[points[i] for i in cycle] for cycle in nx.minimum_cycle_basis(h)]
 
+    return cycles
+
+def point_order(p):
+    """
+    Sort key of a node of the graph induced by the line segments: a point, or a coordinate tuple 
+    (for the ends of overlapping segments), which is a different node than the point.
+    """
+    if isinstance(p, shapely.Point):
+        return (p.x, p.y, 0)
+
+    return (*p, 1)
+
+def add_intersection(g, seg1, seg2):
+    """
+    Adds the intersection of two segments to the graph induced by the non-intersecting 
+    segments. Returns the nodes of the graph touched by it.
+    """
+    def add_edge_ifneq(g, a, b):
+        if a != b:
+            g.add_edge(a,b)
+
+    if not seg1.intersects(seg2):
+        return []
+    
+    inter = seg1.intersection(seg2)
+    
+    s1, t1 = get_endpoints(seg1)
+    s2, t2 = get_endpoints(seg2)
+
+    if isinstance(inter, shapely.Point):  
+        nodes = [s1, s2, t1, t2, inter]
+
+        g.add_nodes_from(nodes)
+        
+        add_edge_ifneq(g, s1, inter)
+        add_edge_ifneq(g, s2, inter)
+        add_edge_ifneq(g, inter, t1)
+        add_edge_ifneq(g, inter, t2)
+    else:
+        i1, i2 = inter.coords
+        
+        nodes = [s1, s2, t1, t2, i1, i2]
+
+        g.add_nodes_from(nodes)
+        
+        # idk about edges in this case :(
+
+    return nodes
+
+def cycle_polygons(cycles):
+    """
+    Constructs polygons from the cycles of the graph induced by the line segments.
+    """
     polygons = []
     for c in cycles:
         lsc = shapely.LineString(c)
@@ -0,0 +1,218 @@
+import networkx as nx
+import numpy as np
+
+from collections import Counter
+
+"""
+Compact, array-backed topology graphs, for storing graphs in the database.
+
+A networkx graph keeps a dictionary per node and edge (and a set of vertex coordinates
+per node, as extracted), which dominates the memory and pickling cost of the database.
+A compact graph keeps the same information in three arrays:
+
+- features:  (nodes, len(FEATURES)) float32 matrix of the node features
+- edges:     (edges, 2) int32 array of node index pairs
+- relations: (edges,) int8 array of relation codes, indexing RELATIONS
+
+Nodes are numbered 0..n-1, in the order of the networkx graph they were converted from.
+
+Graphs with the same topology (Weisfeiler-Lehman hash with relation labels) can be collapsed
+into a single representative, which keeps the counts of their labels.
+"""
+
+FEATURES  = ('x', 'y', 'vertices', 'length', 'area', 'radius', 'bounds')
+RELATIONS = ('neighbor', 'parent')
+
+WL_ITERATIONS = 3
+
+class CompactGraph:
+    """
+    A topology graph stored as arrays, with the parts of the networkx interface
+    used by the database, descriptors and matching.
+    """
+
+    __slots__ = ('label', 'features', 'edges', 'relations', 'counts', 'hash')
+
+    def __init__(self, label, features, edges, relations, counts=None, hash=None):
+        self.label = label
+        self.features = features
+        self.edges = edges
+        self.relations = relations
+
+        # Label counts of the graphs a representative stands for, and its topology hash (see collapse)
+        self.counts = counts
+        self.hash = hash
+
+    @classmethod
+    def from_networkx(cls, G):
+        """
+        Converts a graph extracted by extract_graph.
+        """
+        index = {u: i for i, u in enumerate(G.nodes)}
+
+        features = np.empty((len(index), len(FEATURES)), dtype=np.float32)
+        for u, attribs in G.nodes.items():
+            (x, y), vertices = attribs['position'], attribs['vertices']
+
+            # Only the number of vertices is kept
+            if not isinstance(vertices, (int, np.integer)):
+                vertices = len(vertices)
+
+            features[index[u]] = (x, y, vertices, attribs['length'], attribs['area'],
+                                  attribs['radius'], attribs['bounds'])
+
+        edges = np.array([(index[u], index[v]) for u, v in G.edges], dtype=np.int32).reshape(-1, 2)
+        relations = np.array([RELATIONS.index(r) for _, _, r in G.edges.data('relation')], dtype=np.int8)
+
+        return cls(G.graph.get('label'), features, edges, relations)
+
+    def to_networkx(self) -> nx.Graph:
+        """
+        Converts back to a networkx graph, e.g. for plotting.
+        The vertices attribute of nodes is their number of vertices.
+        """
+        G = nx.Graph()
+
+        for i, f in enumerate(self.features.tolist()):
+            attribs = dict(zip(FEATURES, f))
+            attribs['position'] = (attribs.pop('x'), attribs.pop('y'))
+            attribs['vertices'] = int(attribs['vertices'])
+
+            G.add_node(i, **attribs)
+
+        for (u, v), r in zip(self.edges.tolist(), self.relations.tolist()):
+            G.add_edge(u, v, relation=RELATIONS[r])
+
+        G.graph['label'] = self.label
+
+        return G
+
+    @property
+    def graph(self):
+        # Graph attributes, like networkx's (read-only)
+        return {'label': self.label}
+
+    @property
+    def nodes(self):
+        return range(len(self.features))
+
+    def number_of_nodes(self):
+        return len(self.features)
+
+    def number_of_edges(self):
+        return len(self.edges)
+
+    def feature_matrix(self, names=FEATURES):
+        """
+        Returns the columns of the node feature matrix with the given names.
+        """
+        return self.features[:, [FEATURES.index(n) for n in names]].astype(float)
+
+    def positions(self):
+        """
+        Returns the (2, nodes) array of node positions.
+        """
+        return self.features[:, :2].T.astype(float)
+
+    def adjacency(self):
+        """
+        Returns the dense adjacency matrix, like nx.to_numpy_array.
+        """
+        n = len(self.features)
+
+        A = np.zeros((n, n))
+        A[self.edges[:, 0], self.edges[:, 1]] = 1
+        A[self.edges[:, 1], self.edges[:, 0]] = 1
+
+        return A
+
+    def __getstate__(self):
+        # Raw bytes pickle much smaller than arrays, whose dtypes are pickled with them
+        return (self.label, self.features.tobytes(), self.edges.tobytes(), self.relations.tobytes(), 
+                self.counts, self.hash)
+
+    def __setstate__(self, state):
+        label, features, edges, relations, *rest = state
+        self.counts, self.hash = rest or (None, None)
+
+        self.label = label
+        self.features = np.frombuffer(features, dtype=np.float32).reshape(-1, len(FEATURES))
+        self.edges = np.frombuffer(edges, dtype=np.int32).reshape(-1, 2)
+        self.relations = np.frombuffer(relations, dtype=np.int8)
+
+    def __repr__(self):
+        return f"CompactGraph(label={self.label!r}, nodes={self.number_of_nodes()}, edges={self.number_of_edges()})"
+
+def compact(graph) -> CompactGraph:
+    """
+    Returns the compact graph of a networkx or compact graph.
+    """
+    if isinstance(graph, CompactGraph):
+        return graph
+
+    return CompactGraph.from_networkx(graph)
+
+def adjacency_matrix(graph) -> np.array:
+    """
+    Returns the dense adjacency matrix of a networkx or compact graph.
+    """
+    if isinstance(graph, CompactGraph):
+        return graph.adjacency()
+
+    return nx.to_numpy_array(graph)
+
+def position_matrix(graph) -> np.array:
+    """
+    Returns the (2, nodes) array of node positions of a networkx or compact graph.
+    """
+    if isinstance(graph, CompactGraph):
+        return graph.positions()
+
+    return np.array(list(nx.get_node_attributes(graph, 'position').values())).T
+
+def topology_hash(graph, iterations=WL_ITERATIONS) -> str:
+    """
+    Returns the Weisfeiler-Lehman hash of the topology (nodes, and edges with their relation) 
+    of a networkx or compact graph. Graphs with the same topology have the same hash.
+    """
+    if isinstance(graph, CompactGraph):
+        G = nx.Graph()
+        G.add_nodes_from(range(graph.number_of_nodes()))
+        G.add_edges_from((u, v, {'relation': RELATIONS[r]}) 
+                         for (u, v), r in zip(graph.edges.tolist(), graph.relations.tolist()))
+    else:
+        G = graph
+
+    return nx.weisfeiler_lehman_graph_hash(G, edge_attr='relation', iterations=iterations)
+
+def collapse(descriptors, graphs):
+    """
+    Groups the graphs with the same descriptor and topology, yielding the (descriptor, representative) 
+    of each group. A representative is the compact graph of the group's first graph, labelled with 
+    the group's most common label, with the counts of the group's labels.
+    """
+    groups = {}
+
+    for d, g in zip(descriptors, graphs):
+        h = topology_hash(g)
+        k = (bytes(d), h)
+
+        if k not in groups:
+            representative = compact(g)
+            groups[k] = (d, CompactGraph(representative.label, representative.features, representative.edges, 
+                                         representative.relations, Counter(), h))
+
+        groups[k][1].counts.update(label_counts(g))
+
+    for d, g in groups.values():
+        g.label = g.counts.most_common(1)[0][0]
+        yield d, g
+
+def label_counts(graph) -> dict:
+    """
+    Returns the label counts of the graphs a graph stands for: itself, unless it is a representative.
+    """
+    if isinstance(graph, CompactGraph) and graph.counts is not None:
+        return graph.counts
+
+    return {graph.graph['label']: 1}
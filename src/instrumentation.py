@@ -0,0 +1,168 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+"""
+Opt-in timing and size instrumentation of the pipeline stages.
+
+Disabled by default. Enable it for a block of code with
+
+    with instrument() as recorder:
+        ...
+    print(recorder.summary())
+    recorder.save_trace('trace.json') # open in chrome://tracing or https://ui.perfetto.dev
+
+or for a whole process by setting the environment variable SKETCHER_INSTRUMENT=1,
+which prints the summary at exit, and saves the trace to SKETCHER_TRACE if set.
+"""
+
+ENVIRONMENT_VARIABLE = 'SKETCHER_INSTRUMENT'
+TRACE_VARIABLE = 'SKETCHER_TRACE'
+
+class Recorder:
+    """
+    Records the wall time and sizes of each stage call.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+
+    def record(self, name, start, end, sizes):
+        # list.append is atomic, so stages can be recorded from any thread
+        self.events.append((name, start, end, threading.get_ident(), dict(sizes)))
+
+    def stages(self):
+        """
+        Returns, for each stage, its call count, wall times and sizes.
+        """
+        stages = defaultdict(lambda: {'calls': 0, 'times': [], 'sizes': defaultdict(list)})
+
+        for name, start, end, _, sizes in self.events:
+            s = stages[name]
+            s['calls'] += 1
+            s['times'].append(end - start)
+            for k, v in sizes.items():
+                s['sizes'][k].append(v)
+
+        return stages
+
+    def summary(self):
+        """
+        Returns a table of the call count, total/mean/max wall time and mean/max sizes of each stage.
+        """
+        rows = [f"{'stage':>24} {'calls':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9}  sizes (mean/max)"]
+
+        stages = self.stages()
+        for name in sorted(stages, key=lambda n: -sum(stages[n]['times'])):
+            s = stages[name]
+            times = np.array(s['times'])*1000
+
+            sizes = ' '.join(f"{k}={np.mean(v):.1f}/{np.max(v):g}" for k, v in s['sizes'].items())
+
+            rows.append(f"{name:>24} {s['calls']:>7} {times.sum():>10.2f} {times.mean():>9.3f} "
+                        f"{times.max():>9.3f}  {sizes}")
+
+        return '\n'.join(rows)
+
+    def trace(self):
+        """
+        Returns the recorded stages in the Chrome trace event format.
+        """
+        pid = os.getpid()
+
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.origin)*1e6,
+            'dur': (end - start)*1e6,
+            'pid': pid,
+            'tid': tid,
+            'args': sizes,
+        } for name, start, end, tid, sizes in self.events]
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.trace(), f)
+
+# The active recorder, if instrumentation is enabled
+RECORDER = None
+
+@contextmanager
+def stage(name, **sizes):
+    """
+    Records the wall time of a pipeline stage, if instrumentation is enabled.
+
+    Yields a dictionary of sizes, to which the stage can add the sizes it finds out.
+    """
+    recorder = RECORDER
+
+    if recorder is None:
+        yield sizes
+        return
+
+    start = time.perf_counter()
+    try:
+        yield sizes
+    finally:
+        recorder.record(name, start, time.perf_counter(), sizes)
+
+def staged(name, sizes=None):
+    """
+    Decorator recording each call of a function as a stage, if instrumentation is enabled.
+
+    sizes(result, *args, **kwargs) can return the sizes of a call, from its arguments and result.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if RECORDER is None:
+                return f(*args, **kwargs)
+
+            with stage(name) as s:
+                result = f(*args, **kwargs)
+                if sizes is not None:
+                    s.update(sizes(result, *args, **kwargs))
+                return result
+
+        return wrapper
+    return decorator
+
+@contextmanager
+def instrument():
+    """
+    Enables instrumentation inside the block, yielding its recorder.
+    """
+    global RECORDER
+
+    previous = RECORDER
+    RECORDER = Recorder()
+
+    try:
+        yield RECORDER
+    finally:
+        RECORDER = previous
+
+def report(recorder):
+    """
+    Prints the summary of a recorder, and saves its trace if requested by the environment.
+    """
+    print(recorder.summary())
+
+    filename = os.environ.get(TRACE_VARIABLE)
+    if filename:
+        recorder.save_trace(filename)
+
+if os.environ.get(ENVIRONMENT_VARIABLE, '') not in ('', '0'):
+    RECORDER = Recorder()
+    atexit.register(report, RECORDER)
@@ -1,44 +1,346 @@
 import numpy as np
 
-import networkx as nx
-
-import pygmtools as pygm
-
-import matplotlib.pyplot as plt
-from matplotlib.patches import ConnectionPatch
+# pygmtools, sklearn and matplotlib are imported on first use, as they are slow to import
 
 import functools
+import heapq
+import time
 from typing import Optional, Tuple
 
 # from sklearn.decomposition import PCA as PCAdimReduc
-from sklearn.feature_extraction import DictVectorizer
 
-pygm.BACKEND = 'numpy' # set numpy as backend for pygmtools
+from src.instrumentation import stage, staged
+from src.graph import CompactGraph, adjacency_matrix, position_matrix
+
+# Node features used for matching, in the (sorted) order DictVectorizer gives them
+NODE_FEATURES = ['area', 'bounds', 'length', 'radius', 'x', 'y']
 
 
-def match(graph1, graph2) -> np.array:
+def load_pygmtools():
+    """
+    Imports pygmtools on first use, with numpy as its backend.
+    """
+    import pygmtools as pygm
+    pygm.BACKEND = 'numpy' # set numpy as backend for pygmtools
+    return pygm
+
+
+# Solver parameters
+MAX_ITER  = 50
+TOLERANCE = 1e-5 # change of the solution between iterations, below which it has converged
+
+# Graphs with this many nodes or fewer are matched by node features only
+FAST_NODES = 2
+
+# Width of the gaussian affinity of edge features (lengths)
+EDGE_SIGMA = 1
+
+# Rough costs (seconds) used to pick a solver under a time budget: building the affinity matrix 
+# costs per entry, and RRWM has a high fixed cost per iteration (from its Sinkhorn steps)
+AFFINITY_COST  = 1e-7
+ITERATION_COST = {'rrwm': 3e-3, 'spectral': 5e-5}
+
+
+@staged('match', lambda X, graph1, graph2, *args, **kwargs: {'nodes1': graph1.number_of_nodes(), 
+                                                              'nodes2': graph2.number_of_nodes()})
+def match(graph1, graph2, solver='auto', budget=None, **params) -> np.array:
     """
     Uses a graph match solver to find a match between two topological feature graphs.
     
     Uses the Quadratic Assignment Problem formulation of graph matching to encode graphs.
     
-    The solver and parameters utilized are an implementation detail in this function.
+    The solver is one of SOLVERS, or picked by choose_solver from the graph sizes and the 
+    time budget (seconds) if 'auto'. Other parameters are passed to the solver.
+    """
+    return match_report(graph1, graph2, solver, budget, **params)['X']
+
+
+def match_score(graph1, graph2, solver='auto', budget=None, **params) -> Tuple[np.array, float]:
     """
-    K = build_affinity(graph1, graph2)
-    X = pygm.rrwm(K, graph1.number_of_nodes(), graph2.number_of_nodes())
-    return pygm.hungarian(X)
+    Like match, but also returns the QAP objective achieved by the match.
+    """
+    report = match_report(graph1, graph2, solver, budget, **params)
+    return report['X'], report['objective']
+
+
+def match_report(graph1, graph2, solver='auto', budget=None, **params) -> dict:
+    """
+    Like match, but returns a report of the match: the mapping matrix X, the solver used, 
+    the objective it achieved, its number of iterations and its wall time.
+
+    The 'linear' solver only matches node affinities, but its match is scored with the same 
+    QAP objective as the others (see match_objective), so that their scores can be compared.
+    """
+    start = time.perf_counter()
+
+    n1, n2 = graph1.number_of_nodes(), graph2.number_of_nodes()
+
+    if solver == 'auto':
+        solver = choose_solver(n1, n2, budget, params.get('max_iter', MAX_ITER))
+
+    if budget is not None:
+        params['deadline'] = start + budget
+
+    if solver == 'linear':
+        A = node_affinity(graph1, graph2)
+        X, iterations = linear(A, n1, n2)
+        score = match_objective(graph1, graph2, X, A)
+    else:
+        K = build_affinity(graph1, graph2)
+        X, iterations = solve(K, n1, n2, solver, **params)
+        score = objective(K, X)
+
+    return {'X': X, 'solver': solver, 'objective': score, 'iterations': iterations, 
+            'time': time.perf_counter() - start}
+
+
+def choose_solver(n1, n2, budget=None, max_iter=MAX_ITER) -> str:
+    """
+    Picks a solver for graphs of the given sizes:
+    - Node features only ('linear') for tiny graphs, whose few edges hardly constrain the match
+    - RRWM if it fits in the time budget (seconds) or there is no budget
+    - Spectral matching if it fits in the budget
+    - Otherwise node features only
+    """
+    if min(n1, n2) <= FAST_NODES:
+        return 'linear'
+
+    if budget is None:
+        return 'rrwm'
+
+    affinity = (n1*n2)**2 * AFFINITY_COST
+
+    for solver in ['rrwm', 'spectral']:
+        if affinity + max_iter*ITERATION_COST[solver] <= budget:
+            return solver
+
+    return 'linear'
+
+
+@staged('solve', lambda result, K, n1, n2, solver='rrwm', *args, **kwargs: {'n1': n1, 'n2': n2, 
+                                                                            'iterations': result[1]})
+def solve(K, n1, n2, solver='rrwm', **params) -> Tuple[np.array, int]:
+    """
+    Solves the QAP for an affinity matrix with one of SOLVERS, 
+    returning a discrete mapping matrix and the number of iterations.
+    """
+    pygm = load_pygmtools()
+
+    X, iterations = SOLVERS[solver](K, n1, n2, **params)
+    return pygm.hungarian(X), iterations
+
+
+def rrwm(K, n1, n2, x0=None, max_iter=MAX_ITER, tol=TOLERANCE, deadline=None, **params):
+    """
+    Reweighted random walk matching, warm started from the (n1, n2) matrix x0 if given.
+    Other parameters (sk_iter, alpha, beta) are passed to pygmtools.rrwm.
+    """
+    pygm = load_pygmtools()
+
+    # Step a single iteration at a time, as pygmtools doesn't report iterations or take a tolerance
+    return iterate(lambda X: pygm.rrwm(K, n1, n2, x0=X[None], max_iter=1, **params), 
+                   initial(n1, n2, x0, K.dtype), max_iter, tol, deadline)
+
+
+def spectral(K, n1, n2, x0=None, max_iter=MAX_ITER, tol=TOLERANCE, deadline=None):
+    """
+    Spectral matching (power iteration to the leading eigenvector of K), 
+    warm started from the (n1, n2) matrix x0 if given.
+    """
+    pygm = load_pygmtools()
+
+    return iterate(lambda X: pygm.sm(K, n1, n2, x0=X[None], max_iter=1), 
+                   initial(n1, n2, x0, K.dtype), max_iter, tol, deadline)
+
+
+def ipfp(K, n1, n2, x0=None, max_iter=MAX_ITER, tol=TOLERANCE, deadline=None):
+    """
+    Integer projected fixed point matching (Leordeanu et al. 2009), warm started from the 
+    (n1, n2) matrix x0 if given. Returns the best discrete solution found.
+    """
+    pygm = load_pygmtools()
+
+    x = initial(n1, n2, x0, K.dtype).T.reshape(-1)
+
+    best, best_score = None, -np.inf
+    for i in range(1, max_iter + 1):
+        # Discrete solution maximizing the first order approximation of the objective at x
+        B = pygm.hungarian((K @ x).reshape(n2, n1).T, n1, n2)
+        b = B.T.reshape(-1)
+
+        score = float(b @ K @ b)
+        if score <= best_score*(1 + tol):
+            break
+        best, best_score = B, score
+
+        # Line search between x and b
+        d = b - x
+        C, D = x @ K @ d, d @ K @ d
+        x = b if D >= 0 else x + min(-C/D, 1)*d
+
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+
+    return best, i
+
+
+def linear(A, n1, n2, **params):
+    """
+    Linear assignment of nodes maximizing their total affinity A (n1, n2), ignoring edges.
+    """
+    pygm = load_pygmtools()
+
+    return pygm.hungarian(A, n1, n2), 1
 
 
+def iterate(step, X, max_iter=MAX_ITER, tol=TOLERANCE, deadline=None):
+    """
+    Repeats a solver step until the solution converges, max_iter steps were made or the deadline passed.
+    Returns the solution and the number of steps.
+    """
+    for i in range(1, max_iter + 1):
+        previous, X = X, step(X)
+
+        if np.linalg.norm(X - previous) < tol:
+            break
+
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+
+    return X, i
+
+
+def initial(n1, n2, x0=None, dtype=float):
+    """
+    The starting (n1, n2) solution of a solver, uniform if not warm started.
+    """
+    if x0 is None:
+        return np.full((n1, n2), 1/(n1*n2), dtype=dtype)
+
+    return np.asarray(x0, dtype=dtype)
+
+
+SOLVERS = {'rrwm': rrwm, 'spectral': spectral, 'ipfp': ipfp}
+
+
+def objective(K, X) -> float:
+    """
+    The QAP objective vec(X)^T K vec(X) of a mapping matrix X.
+    """
+    x = X.T.reshape(-1)
+    return float(x @ K @ x)
+
+
+def match_objective(graph1, graph2, X, A=None) -> float:
+    """
+    The QAP objective of a mapping matrix X, as objective(build_affinity(graph1, graph2), X), 
+    computed from the matched nodes and edges without building the affinity matrix. 
+    A is the node affinity of the graphs, if already computed.
+    """
+    if A is None:
+        A = node_affinity(graph1, graph2)
+
+    nodes = float((A*X).sum())
+
+    # Pairs of matches (i, a), (j, b) whose edges (i, j) and (a, b) both exist
+    i, a = X.nonzero()
+    w = X[i, a]
+
+    E1 = extract_edge_features(graph1)[np.ix_(i, i)]
+    E2 = extract_edge_features(graph2)[np.ix_(a, a)]
+
+    # Edges are the nonzero edge features, as in encode
+    edges = np.exp(-(E1 - E2)**2 / EDGE_SIGMA) * ((E1 != 0) & (E2 != 0))
+
+    return nodes + float((w[:, None] * edges * w[None, :]).sum())
+
+
+def node_affinity(graph1, graph2) -> np.array:
+    """
+    The (n1, n2) affinities of the nodes of two graphs, the node terms of their affinity matrix.
+    """
+    return extract_node_features(graph1) @ extract_node_features(graph2).T
+
+
+def upper_bound(graph1, graph2) -> float:
+    """
+    An upper bound of the QAP objective any match of two graphs can achieve, much cheaper than matching:
+    - Node terms: at most the best linear assignment of node affinities
+    - Edge terms: each directed edge is matched to at most one, with a (gaussian) affinity of at most 1
+    """
+    pygm = load_pygmtools()
+
+    n1, n2 = graph1.number_of_nodes(), graph2.number_of_nodes()
+    if n1 == 0 or n2 == 0:
+        return 0.0
+
+    A = node_affinity(graph1, graph2)
+    nodes = float((A*pygm.hungarian(A, n1, n2)).sum())
+
+    return nodes + 2*min(graph1.number_of_edges(), graph2.number_of_edges())
+
+
+def best_matches(query, candidates, k=1, solver='auto', budget=None, **params):
+    """
+    Matches the query graph against the candidate graphs, returning the (index, score) of the k best 
+    candidates, best first, and the number of candidates matched and pruned.
+
+    Candidates are matched in order of their upper bound, and the ones whose upper bound can't beat 
+    the k-th best score so far are pruned without matching. The budget (seconds) is shared by the 
+    candidates that are matched.
+    """
+    if query.number_of_nodes() == 0:
+        return [], {'solved': 0, 'pruned': len(candidates)}
+
+    bounds = [upper_bound(query, g) for g in candidates]
+
+    # Empty graphs can't be matched
+    order = sorted((i for i, g in enumerate(candidates) if g.number_of_nodes() > 0), key=lambda i: -bounds[i])
+
+    best = [] # min-heap of the k best (score, index)
+    solved = 0
+
+    for n, i in enumerate(order):
+        if len(best) == k and bounds[i] <= best[0][0]:
+            break # so are all the remaining candidates, which have lower bounds
+
+        share = None if budget is None else budget/(len(order) - n)
+        if budget is not None:
+            budget -= share
+
+        solved += 1
+        try:
+            _, score = match_score(query, candidates[i], solver, share, **params)
+        except ValueError: # solver diverged (degenerate affinities)
+            continue
+
+        if len(best) < k:
+            heapq.heappush(best, (score, i))
+        elif score > best[0][0]:
+            heapq.heapreplace(best, (score, i))
+
+    with stage('prune', candidates=len(candidates)) as sizes:
+        sizes.update(solved=solved, pruned=len(candidates) - solved)
+
+    return [(i, score) for score, i in sorted(best, reverse=True)], {'solved': solved, 'pruned': len(candidates) - solved}
+
+
+@staged('build_affinity', lambda K, *args: {'affinity': K.shape[0]})
 def build_affinity(graph1, graph2) -> np.array:
     """
     Construct affinity matrix for matching QAP solver.
     """
+    pygm = load_pygmtools()
+
     node1, edge1, conn1 = encode(graph1)
     node2, edge2, conn2 = encode(graph2)
     
-    gaussian_aff = functools.partial(pygm.utils.gaussian_aff_fn, sigma=1) # set affinity function
+    gaussian_aff = functools.partial(pygm.utils.gaussian_aff_fn, sigma=EDGE_SIGMA) # set affinity function
     
-    return pygm.utils.build_aff_mat(node1, edge1, conn1, node2, edge2, conn2, edge_aff_fn=gaussian_aff)
+    # Node counts are given explicitly, as they can't be inferred from connectivity with isolated nodes
+    n1, n2 = graph1.number_of_nodes(), graph2.number_of_nodes()
+
+    return pygm.utils.build_aff_mat(node1, edge1, conn1, node2, edge2, conn2, n1=n1, n2=n2, edge_aff_fn=gaussian_aff)
 
 def encode(graph) -> Tuple[np.array, np.array, np.array]:
     """
@@ -46,6 +348,8 @@ def encode(graph) -> Tuple[np.array, np.array, np.array]:
     connectivity matrix triple. This is fed to a QAP solver to match graphs.
     
     """
+    pygm = load_pygmtools()
+
     # Extract array node features
     n_f = extract_node_features(graph)
     
@@ -68,7 +372,7 @@ def extract_edge_features(graph) -> np.array:
     https://scikit-learn.org/stable/modules/feature_extraction.html
     """
     # Get adjacency matrix from graph
-    A = nx.to_numpy_array(graph)
+    A = adjacency_matrix(graph)
 
     if not np.any(A): # if all zeros
         return A
@@ -77,15 +381,17 @@ def extract_edge_features(graph) -> np.array:
     # Length feature
     # ----------------
     
-    # Get a 'positions' graph attribute:
-    pos = nx.get_node_attributes(graph,'position')
-    
-    # Convert position dictionary to numpy array
-    pos_arr = position_array(pos)
+    # Get node positions as a numpy array
+    pos_arr = position_matrix(graph)
 
     # Derive edge distances from adjacency matrix
     A = ((np.expand_dims(pos_arr, 1) - np.expand_dims(pos_arr, 2)) ** 2).sum(axis=0) * A
-    A = (A / A.max()).astype(np.float32)
+
+    # Edges between nodes with the same centroid (e.g. concentric shapes) have zero length
+    if A.max() > 0:
+        A = A / A.max()
+
+    A = A.astype(np.float32)
     
     return A
 
@@ -103,6 +409,12 @@ def extract_node_features(graph) -> Optional[np.array]:
     """
     if graph.number_of_nodes() == 0:
         return None
+
+    # Compact graphs already store their features as a matrix
+    if isinstance(graph, CompactGraph):
+        return graph.feature_matrix(NODE_FEATURES)
+
+    from sklearn.feature_extraction import DictVectorizer
     
     vec = DictVectorizer()
 
@@ -128,13 +440,13 @@ def plot_match_graph(G, color='k'):
     """
     Plots a given graph with a 'positions' attribute.
     """
-    A = nx.to_numpy_array(G)
+    import matplotlib.pyplot as plt
+
+    A = adjacency_matrix(G)
     if 'positions' in G.graph:
-        pos = G.graph['positions']
+        pts = position_array(G.graph['positions'])
     else:
-        pos = nx.get_node_attributes(G,'position')
-
-    pts = position_array(pos)
+        pts = position_matrix(G)
     plt.scatter(pts[0], pts[1], c='w', edgecolors=color)
 
     for x, y in zip(np.nonzero(A)[0], np.nonzero(A)[1]):
@@ -159,9 +471,9 @@ def mapping_to_list(X, G1, G2):
     return pairs
 
 def plot_mapping(X, graph1, graph2):
-    pos1 = nx.get_node_attributes(graph1,'position')
-    pos2 = nx.get_node_attributes(graph2,'position')
-    
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import ConnectionPatch
+
     plt.figure(figsize=(8, 4))
     plt.suptitle('Image Matching Result by RRWM')
 
@@ -171,8 +483,8 @@ def plot_mapping(X, graph1, graph2):
     ax2 = plt.subplot(1, 2, 2)
     plot_match_graph(graph2)
 
-    pts1 = position_array(pos1)
-    pts2 = position_array(pos2)
+    pts1 = position_matrix(graph1)
+    pts2 = position_matrix(graph2)
     
     for i in range(X.shape[0]):
         j = np.argmax(X[i]).item()
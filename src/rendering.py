@@ -0,0 +1,161 @@
+import numpy as np
+
+from src.graph import RELATIONS, adjacency_matrix, position_matrix
+
+"""
+Fast plotting of extraction results in the GUI.
+
+A Renderer keeps a single matplotlib figure embedded in a Tk window, and updates its
+artists (collections of lines, polygons and nodes) in place instead of creating a new
+figure per plot. The artists are animated, so when the axes don't change, only they are
+redrawn over a cached background (blitting).
+
+matplotlib is imported when the first renderer is created, as it is slow to import.
+"""
+
+MARGIN = 0.05 # of the data size, around the plotted data
+
+NODE_SIZE  = 500
+NODE_COLOR = 'blue'
+ALPHA      = 0.5
+
+def colors(n):
+    """
+    The colors of n plotted items, cycling like separate plot calls do.
+    """
+    return [f"C{i % 10}" for i in range(n)]
+
+class Renderer:
+    """
+    A single figure embedded in a Tk window, showing line strings, polygons or graphs.
+    """
+
+    def __init__(self, master, **grid):
+        """
+        Creates the figure and its canvas, placed in master with the given grid options.
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.collections import LineCollection, PolyCollection
+
+        # Not a pyplot figure, so that it isn't kept alive by pyplot
+        self.figure = Figure()
+        self.ax = self.figure.add_subplot()
+
+        self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+        self.canvas.get_tk_widget().grid(**grid)
+
+        self.polygons = PolyCollection([], alpha=ALPHA, animated=True)
+        self.lines = LineCollection([], animated=True)
+        self.nodes = self.ax.scatter([], [], s=NODE_SIZE, c=NODE_COLOR, alpha=ALPHA, animated=True)
+        self.labels = []
+
+        self.ax.add_collection(self.polygons)
+        self.ax.add_collection(self.lines)
+
+        self.limits = None
+        self.background = None
+
+        # The background is cached on every full redraw (including resizes)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def show_line_strings(self, line_strings):
+        segments = [np.asarray(ls.coords) for ls in line_strings]
+
+        self.show('Line strings', lines=segments, line_colors=colors(len(segments)))
+
+    def show_polygons(self, polygons):
+        outlines = [np.asarray(p.exterior.coords) for p in polygons if p is not None]
+
+        self.show('Polygons', lines=outlines, line_colors=colors(len(outlines)), polygons=outlines)
+
+    def show_graph(self, G):
+        if G.number_of_nodes() == 0:
+            self.show('Topology graph')
+            return
+
+        pos = position_matrix(G).T
+
+        A = np.triu(adjacency_matrix(G))
+        edges = [pos[[u, v]] for u, v in zip(*A.nonzero())]
+
+        labels = [((pos[u] + pos[v])/2, r) for (u, v), r in edge_relations(G)]
+
+        self.show('Topology graph', lines=edges, line_colors=['black'], nodes=pos, labels=labels)
+
+    def clear(self, title=''):
+        self.show(title)
+
+    def show(self, title, lines=(), line_colors=('black',), polygons=(), nodes=None, labels=()):
+        """
+        Updates the artists with the given line segments, polygons, node positions and (position, text) labels.
+        Redraws the whole figure only if the title or axes limits change, and blits the artists otherwise.
+        """
+        self.lines.set_segments(lines)
+        self.lines.set_color(line_colors)
+
+        self.polygons.set_verts(polygons)
+        self.polygons.set_facecolor(colors(len(polygons)))
+
+        self.nodes.set_offsets(np.empty((0, 2)) if nodes is None else nodes)
+
+        for t in self.labels:
+            t.remove()
+        self.labels = [self.ax.text(x, y, text, color='red', ha='center', va='center', animated=True)
+                       for (x, y), text in labels]
+
+        limits = data_limits([*lines, *polygons] + ([] if nodes is None else [nodes]))
+
+        if title != self.ax.get_title() or limits != self.limits or self.background is None:
+            self.ax.set_title(title)
+            self.limits = limits
+
+            if limits is not None:
+                minx, miny, maxx, maxy = limits
+                self.ax.set_xlim(minx, maxx)
+                self.ax.set_ylim(maxy, miny) # inverted, as in image coordinates
+
+            # Redraws the background, then the artists (see on_draw)
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+            self.canvas.blit(self.figure.bbox)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in [self.polygons, self.lines, self.nodes, *self.labels]:
+            self.figure.draw_artist(artist)
+
+    def destroy(self):
+        self.canvas.get_tk_widget().destroy()
+        self.figure.clear()
+
+def edge_relations(G):
+    """
+    The ((u, v), relation) of each edge of a networkx or compact graph, with nodes numbered 0..n-1.
+    """
+    if hasattr(G, 'relations'):
+        return [(tuple(e), RELATIONS[r]) for e, r in zip(G.edges.tolist(), G.relations.tolist())]
+
+    index = {u: i for i, u in enumerate(G.nodes)}
+    return [((index[u], index[v]), r) for u, v, r in G.edges.data('relation')]
+
+def data_limits(arrays):
+    """
+    The (minx, miny, maxx, maxy) bounds of the points of arrays, with a margin, or None if there are none.
+    """
+    arrays = [np.asarray(a).reshape(-1, 2) for a in arrays if len(a)]
+    if not arrays:
+        return None
+
+    points = np.concatenate(arrays)
+    (minx, miny), (maxx, maxy) = points.min(axis=0), points.max(axis=0)
+
+    dx = max(maxx - minx, 1)*MARGIN
+    dy = max(maxy - miny, 1)*MARGIN
+
+    return (float(minx - dx), float(miny - dy), float(maxx + dx), float(maxy + dy))
@@ -0,0 +1,362 @@
+import asyncio
+import base64
+import io
+import json
+import logging
+import multiprocessing
+import signal
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from src.svg import load, to_control_points
+from src.vision import get_image_line_strings
+from src.extraction import get_line_strings
+from src.database import open_database, attach_database, close_database, rank_labels, DATABASE_FILENAME, SHARED_DATABASE_FILENAME
+from src.matching import best_matches
+from src.cache import ExtractionCache
+
+"""
+Headless sketch recognition service.
+
+Loads the database once, and answers HTTP requests of the form
+
+    POST /query
+    {"strokes": [[[x, y], ...], ...]} or {"svg": "<svg ...>"} or {"png": "<base64>"}
+
+with the ranked labels of the nearest graphs in the database:
+
+    {"labels": [[label, count], ...], "matches": [[label, score], ...]}
+
+or of the graphs with the same topology, if the database has them (see graph.collapse):
+
+    {"labels": [[label, count], ...], "exact": true}
+
+and GET /stats requests with the hit rate of the database query cache, and the number of 
+neighbors matched and pruned by refinement.
+
+Run with: python -m src.service [--port PORT] [--database FILENAME] [--shared]
+
+Check that trivial sketches (empty, or a single shape) are answered by the nearest graphs 
+rather than an exact topology match with: python -m src.service --check [--database FILENAME]
+"""
+
+HOST = '127.0.0.1'
+PORT = 8080
+
+MAX_CONCURRENCY = 64       # requests being handled at once, others are refused
+MAX_BODY_SIZE   = 16 << 20 # bytes
+
+BATCH_SIZE   = 32
+BATCH_WINDOW = 0.005 # seconds to wait for more requests before querying a batch
+
+REFINE = 10 # number of neighbors refined with graph matching, by default
+
+REFINE_BUDGET = 0.5 # seconds of graph matching per query, shared by the refined neighbors
+
+MATCHES = 3 # number of best matches returned by refinement; neighbors that can't be among them aren't matched
+
+CANVAS_STEP = 20
+IMAGE_STEP  = 40
+
+# Errors of a malformed request or payload, answered with 400 Bad Request (others with 500)
+REQUEST_ERRORS = (ValueError, asyncio.IncompleteReadError)
+
+log = logging.getLogger(__name__)
+
+"""
+----------------------------
+-- WORKERS (process pool)
+----------------------------
+"""
+
+# Each worker process caches the graphs it extracted, for repeated queries
+CACHE = ExtractionCache()
+
+def extract(payload):
+    """
+    Extracts the query graph of a request payload.
+    """
+    if 'strokes' in payload:
+        line_strings = get_line_strings(payload['strokes'], step=CANVAS_STEP)
+        step = CANVAS_STEP
+
+    elif 'svg' in payload:
+        svg = load(io.StringIO(payload['svg']))
+        line_strings = get_line_strings(map(to_control_points, svg['paths']), step=CANVAS_STEP)
+        step = CANVAS_STEP
+
+    elif 'png' in payload:
+        import cv2
+
+        buffer = np.frombuffer(base64.b64decode(payload['png']), dtype=np.uint8)
+        img = cv2.cvtColor(cv2.imdecode(buffer, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        line_strings = get_image_line_strings(img, step=IMAGE_STEP)
+        step = IMAGE_STEP
+
+    else:
+        raise ValueError("Expected one of 'strokes', 'svg' or 'png'.")
+
+    graph, _ = CACHE.extract(line_strings, None, step=step)
+    return graph
+
+def refine(query, neighbors, top=MATCHES, budget=REFINE_BUDGET):
+    """
+    Matches the query graph against its neighbors, returning the (label, score) pairs of the top best, 
+    best first, and the number of neighbors matched and pruned.
+    The matching solver of each neighbor is picked to fit its share of the time budget.
+    """
+    matches, stats = best_matches(query, neighbors, k=top, budget=budget)
+
+    return [(neighbors[i].graph['label'], score) for i, score in matches], stats
+
+"""
+----------------------------
+-- SERVICE
+----------------------------
+"""
+
+class Service:
+    """
+    Answers queries against a database loaded once, batching concurrent queries
+    into single KD-tree lookups and running extraction and matching in a process pool.
+    """
+
+    def __init__(self, filename=DATABASE_FILENAME, workers=None, K=50, topK=100, shared=False):
+        # Several services on a host can attach to the same shared database file
+        self.db = attach_database(filename) if shared else open_database(filename)
+        # Workers are started on demand, while requests are handled, so they aren't forked from this 
+        # process: they would inherit its open client sockets, which then never close
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+
+        self.K = K
+        self.topK = topK
+
+        # Number of neighbors matched and pruned by refinement
+        self.refinement = {'solved': 0, 'pruned': 0}
+
+        self.limit = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.pending = asyncio.Queue()
+        self.batcher = asyncio.create_task(self.batch_queries())
+
+    async def query(self, payload):
+        """
+        Returns the response to a query payload.
+        """
+        loop = asyncio.get_running_loop()
+
+        graph = await loop.run_in_executor(self.pool, extract, payload)
+
+        # Graphs with the same topology as a representative of the database are answered by its label counts
+        match = self.db.exact_match(graph)
+        if match is not None:
+            return {'labels': rank_labels([match]), 'exact': True}
+
+        # Queue graph for the next batched database query
+        neighbors = loop.create_future()
+        await self.pending.put((graph, neighbors))
+        neighbors = await neighbors
+
+        response = {'labels': rank_labels(neighbors)}
+
+        n = int(payload.get('refine', REFINE))
+        if n > 0:
+            response['matches'], stats = await loop.run_in_executor(self.pool, refine, graph, neighbors[:n])
+
+            for k, v in stats.items():
+                self.refinement[k] += v
+
+        return response
+
+    async def batch_queries(self):
+        """
+        Collects queued graphs into batches, and queries the database with each batch.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.pending.get()]
+
+            # Wait briefly for more queries to arrive
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            graphs = [g for g, _ in batch]
+
+            try:
+                results = await loop.run_in_executor(None, self.db.query_batch, graphs, self.K, self.topK)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), neighbors in zip(batch, results):
+                if not future.done():
+                    future.set_result(neighbors)
+
+    async def handle(self, reader, writer):
+        """
+        Handles a single HTTP request on a connection.
+        """
+        try:
+            status, response = await self.respond(reader)
+        except REQUEST_ERRORS as e: # including json.JSONDecodeError
+            status, response = 400, {'error': str(e)}
+        except Exception as e:
+            log.exception("Error handling request")
+            status, response = 500, {'error': str(e)}
+
+        body = json.dumps(response).encode()
+
+        writer.write((f"HTTP/1.1 {status} {STATUS_NAMES[status]}\r\n"
+                      "Content-Type: application/json\r\n"
+                      f"Content-Length: {len(body)}\r\n"
+                      "Connection: close\r\n\r\n").encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def respond(self, reader):
+        """
+        Reads an HTTP request, and returns the (status, response) to it.
+        """
+        method, path, _ = (await reader.readline()).decode().split()
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode().split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if method == 'GET' and path == '/stats':
+            return 200, {'query_cache': self.db.cache.stats(), 'refinement': self.refinement}
+
+        if method != 'POST' or path != '/query':
+            return 404, {'error': 'Not found'}
+
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_SIZE:
+            return 413, {'error': 'Payload too large'}
+
+        payload = json.loads(await reader.readexactly(length))
+
+        if self.limit.locked():
+            return 503, {'error': 'Too many concurrent requests'}
+
+        async with self.limit:
+            return 200, await self.query(payload)
+
+    async def close(self):
+        """
+        Waits for the requests being handled, then closes the process pool and database.
+        """
+        for _ in range(MAX_CONCURRENCY):
+            await self.limit.acquire()
+
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+
+        self.pool.shutdown()
+
+        close_database(self.db)
+
+# Payloads that must not be answered by an exact match (see check_trivial_queries)
+TRIVIAL_PAYLOADS = [
+    {'strokes': []},
+    {'strokes': [[[0, 0], [400, 0], [400, 400], [0, 400], [0, 0]]]},
+]
+
+async def check_trivial_queries(service):
+    """
+    Queries the service with trivial payloads, returning the ones answered by an exact match.
+    """
+    return [p for p in TRIVIAL_PAYLOADS if (await service.query(p)).get('exact')]
+
+STATUS_NAMES = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+async def serve(host=HOST, port=PORT, filename=DATABASE_FILENAME, workers=None, shared=False):
+    """
+    Serves queries until interrupted (SIGINT/SIGTERM), then shuts down gracefully.
+    """
+    service = Service(filename, workers=workers, shared=shared)
+
+    server = await asyncio.start_server(service.handle, host, port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with server:
+        await stop.wait()
+
+        # Stop accepting connections, then finish the accepted ones
+        server.close()
+        await server.wait_closed()
+
+    await service.close()
+
+"""
+----------------------------
+-- RUNNER
+----------------------------
+"""
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Headless sketch recognition service.")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--database', default=None, 
+                        help=f"database file (default {DATABASE_FILENAME}, or {SHARED_DATABASE_FILENAME} if --shared)")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shared', action='store_true', 
+                        help="attach to a shared database file (see database.share_database)")
+    parser.add_argument('--check', action='store_true', 
+                        help="check that trivial sketches aren't answered by exact matches, and exit")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.database is None:
+        args.database = SHARED_DATABASE_FILENAME if args.shared else DATABASE_FILENAME
+
+    if args.check:
+        async def check():
+            service = Service(args.database, workers=args.workers, shared=args.shared)
+            try:
+                return await check_trivial_queries(service)
+            finally:
+                await service.close()
+
+        exact = asyncio.run(check())
+        for payload in exact:
+            print(f"EXACT MATCH {json.dumps(payload)}")
+        if not exact:
+            print("trivial queries ok")
+
+        raise SystemExit(bool(exact))
+
+    asyncio.run(serve(args.host, args.port, args.database, args.workers, args.shared))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 import numpy as np
 
-import svgpathtools
-import drawsvg as draw
+# svgpathtools and drawsvg are imported on first use, as they are slow to import
 
 from xml.dom import minidom
 
@@ -31,6 +30,8 @@ def load(filename):
     """
     Loads an svg image from the image library given its filename. 
     """
+    import svgpathtools
+
     doc = minidom.parse(filename)
     
     attribs = []
@@ -64,6 +65,8 @@ def display(img, text='test'):
     See svg reference to implement svg commands:
     https://developer.mozilla.org/en-US/docs/Web/SVG/Attribute/d
     """
+    import drawsvg as draw
+
     def draw_curve(command, args, drawn_path):
         if command == 'C':
             drawn_path.C(*args)
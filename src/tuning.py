@@ -0,0 +1,201 @@
+import json
+import math
+import time
+
+import numpy as np
+
+from src.database import NORMALIZATIONS, descriptor, construct_database, DATABASE_FILENAME, DESCRIPTOR_SIZE
+from src.evaluation import IMAGE_DIRECTORY, TEST_FRACTION, load_svg_files, split, extract_files, load_corpus, build, evaluate
+from src.corpus import read_corpus
+from src.graph import label_counts
+
+"""
+Descriptor tuning.
+
+Analyses the node counts of a graph corpus to pick the descriptor size N (the number of
+eigenvalues kept) as a percentile of them, and compares the normalizations of descriptors
+(see database.Normalization) by KD-tree query cost and neighbor quality:
+
+    python -m src.tuning [--corpus FILENAME] [--percentile 99.9] [--normalization none scale whiten pca]
+
+Graphs are extracted from the labelled SVG sketches, or read from a corpus (see src.corpus).
+With --database, a database of all the graphs is constructed with the picked size and the
+best normalization, which is stored with it and applied to queries.
+"""
+
+DESCRIPTOR_PERCENTILE = 99.9
+
+REPEAT = 10 # KD-tree query timing repetitions
+
+"""
+----------------------------
+-- DESCRIPTOR SIZE
+----------------------------
+"""
+
+def node_counts(graphs) -> np.array:
+    return np.array([g.number_of_nodes() for g in graphs])
+
+def choose_descriptor_size(counts, percentile=DESCRIPTOR_PERCENTILE) -> int:
+    """
+    Picks the descriptor size that keeps every eigenvalue of the given percentile of the graphs,
+    by number of nodes.
+    """
+    if len(counts) == 0:
+        return DESCRIPTOR_SIZE
+
+    return max(1, math.ceil(np.percentile(counts, percentile)))
+
+def format_distribution(counts):
+    percentiles = [50, 90, 99, 99.9, 100]
+    values = np.percentile(counts, percentiles)
+
+    return "nodes: " + " ".join(f"p{p:g}={v:.0f}" for p, v in zip(percentiles, values))
+
+"""
+----------------------------
+-- COST AND QUALITY
+----------------------------
+"""
+
+def kdtree_cost(db, keys, K=50, repeat=REPEAT):
+    """
+    Returns the time (microseconds) of a KD-tree query per key, normalized as the database does.
+    """
+    keys = db.normalize(keys)
+
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.kdtree.query(keys, k=K)
+        best = min(best, time.perf_counter() - start)
+
+    return best / len(keys) * 1e6
+
+def neighbor_quality(db, test, keys, K=50):
+    """
+    Returns the fraction of the graphs under the K nearest descriptors of each test graph
+    that have its label, averaged over the test graphs.
+    """
+    precisions = []
+
+    for g, nearest in zip(test, db.nearest(keys, K)):
+        counts = {}
+        for _, i in nearest:
+            for n in db.features(i):
+                for l, c in label_counts(n).items():
+                    counts[l] = counts.get(l, 0) + c
+
+        total = sum(counts.values())
+        precisions.append(counts.get(g.graph['label'], 0) / total if total else 0.0)
+
+    return float(np.mean(precisions))
+
+def tune(train, test, descriptor_sizes, normalizations=NORMALIZATIONS, K=50, repeat=REPEAT):
+    """
+    Evaluates every descriptor size and normalization, returning a list of configurations and their metrics.
+    """
+    results = []
+
+    for N in descriptor_sizes:
+        keys = np.array([descriptor(g, N=N) for g in test])
+
+        for normalization in normalizations:
+            start = time.perf_counter()
+            db = build(train, descriptor_size=N, normalization=normalization)
+            build_time = time.perf_counter() - start
+
+            metrics = evaluate(db, test, K=K)
+            metrics['build'] = build_time
+            metrics['dimensions'] = N if db.normalization is None else db.normalization.size
+            metrics['kdtree'] = kdtree_cost(db, keys, K, repeat)
+            metrics['precision'] = neighbor_quality(db, test, keys, K)
+
+            config = {'descriptor_size': N, 'normalization': normalization, 'K': K}
+            results.append({'config': config, 'metrics': metrics})
+
+            print(format_row(config, metrics))
+
+    return results
+
+def best(results):
+    """
+    Returns the configuration with the best top-1 accuracy, then neighbor precision, 
+    then fewest dimensions and lowest query cost.
+    """
+    r = max(results, key=lambda r: (r['metrics']['top1'], r['metrics']['precision'], 
+                                    -r['metrics']['dimensions'], -r['metrics']['kdtree']))
+    return r['config']
+
+def format_row(config, metrics):
+    return (f"N={config['descriptor_size']:<3} norm={config['normalization']:<6} dims={metrics['dimensions']:<3} | "
+            f"kdtree={metrics['kdtree']:.1f} us/query precision@{config['K']}={metrics['precision']:.3f} | "
+            f"top1={metrics['top1']:.3f} top5={metrics['top5']:.3f} build={metrics['build']*1000:.0f} ms")
+
+"""
+----------------------------
+-- RUNNER
+----------------------------
+"""
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pick the descriptor size and normalization of the database.")
+    parser.add_argument('--directory', default=IMAGE_DIRECTORY)
+    parser.add_argument('--corpus', default=None, help="corpus file to read the graphs from, instead of extracting them")
+    parser.add_argument('--test-fraction', type=float, default=TEST_FRACTION)
+    parser.add_argument('--limit', type=int, default=None, help="max graphs per label")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--percentile', type=float, default=DESCRIPTOR_PERCENTILE,
+                        help="percentile of the node counts to pick the descriptor size from")
+    parser.add_argument('--descriptor-size', type=int, nargs='*', default=[DESCRIPTOR_SIZE],
+                        help="sizes to compare with the picked one")
+    parser.add_argument('--normalization', nargs='+', default=list(NORMALIZATIONS), choices=NORMALIZATIONS)
+    parser.add_argument('--K', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--database', default=None,
+                        help=f"construct a database of all the graphs with the best configuration (e.g. {DATABASE_FILENAME})")
+    parser.add_argument('--output', default=None, help="file to store the results in, as JSON")
+
+    args = parser.parse_args()
+
+    if args.corpus is not None:
+        files = [(r.source, r.label) for r in read_corpus(args.corpus)]
+        train, test = split(files, args.test_fraction, args.limit, args.seed)
+
+        train = load_corpus(train, args.corpus)
+        test  = load_corpus(test, args.corpus)
+    else:
+        train, test = split(load_svg_files(args.directory), args.test_fraction, args.limit, args.seed)
+
+        train = extract_files(train, args.workers)
+        test  = extract_files(test, args.workers)
+
+    counts = node_counts(train + test)
+    N = choose_descriptor_size(counts, args.percentile)
+
+    print(f"train={len(train)} test={len(test)} graphs, {format_distribution(counts)}")
+    print(f"descriptor size at p{args.percentile:g}: N={N}")
+
+    sizes = sorted(set([N] + args.descriptor_size))
+
+    results = tune(train, test, sizes, args.normalization, args.K, args.repeat)
+
+    config = best(results)
+    print(f"best: N={config['descriptor_size']} normalization={config['normalization']}")
+
+    if args.database is not None:
+        graphs = train + test
+        descriptors = [descriptor(g, N=config['descriptor_size']) for g in graphs]
+
+        construct_database(descriptors, graphs, filename=args.database, normalization=config['normalization'])
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'percentile': args.percentile, 'descriptor_size': N, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
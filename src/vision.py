@@ -1,32 +1,112 @@
-import cv2
-import matplotlib.pyplot as plt
 
+# cv2 and matplotlib are imported on first use, as they are slow to import
 from numpy import resize, array
 from shapely import LineString
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import os
+
+from src.instrumentation import staged
+
 DEFAULT_STEP = 40
 
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+log = logging.getLogger(__name__)
+
 def load_image(filename):
     """
     Loads an image from the image library given its filename. 
     """
+    import cv2
+
     img = cv2.imread(filename) 
+    if img is None: # missing, unreadable or corrupt
+        raise ValueError(f"{filename} can't be read as an image")
+
     return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 
+def load_images_line_strings(filenames, step=DEFAULT_STEP, workers=DEFAULT_WORKERS, max_pending=None, **options):
+    """
+    Decodes images and extracts their line strings over a thread pool 
+    (OpenCV releases the GIL while decoding and finding contours).
+
+    Yields (filename, line_strings) pairs in the order of the given filenames. 
+    Files that fail (e.g. unreadable images) are logged and skipped.
+    At most max_pending images (2*workers by default) are in flight at once, 
+    so memory stays bounded for arbitrarily long streams of files.
+
+    Extra keyword options are passed on to get_image_line_strings.
+    """
+    if max_pending is None:
+        max_pending = 2*workers
+
+    def process(filename):
+        return get_image_line_strings(load_image(filename), step=step, **options)
+
+    def completed(pending):
+        f, future = pending.popleft()
+        try:
+            return f, future.result()
+        except Exception as e:
+            log.warning("skipping %s: %s", f, e)
+            return f, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        try:
+            for filename in filenames:
+                if len(pending) >= max_pending:
+                    f, line_strings = completed(pending)
+                    if line_strings is not None:
+                        yield f, line_strings
+
+                pending.append((filename, executor.submit(process, filename)))
+
+            while pending:
+                f, line_strings = completed(pending)
+                if line_strings is not None:
+                    yield f, line_strings
+        finally:
+            # If the generator is closed early, the images not yet started aren't loaded
+            executor.shutdown(cancel_futures=True)
+
 def display_image(img, text='test'):
     """
     Displays a provided image to the user, and wait for any input. Used for debugging.
     """
+    import matplotlib.pyplot as plt
+
     imgplot = plt.imshow(img)
 
     plt.show()
 
-def get_image_line_strings(img, step=DEFAULT_STEP):
+def get_image_line_strings(img, step=DEFAULT_STEP, max_size=None, min_area=0, min_length=0, 
+                           outer_only=False, epsilon=None):
     """
     Converts an image from disk to a list of line strings, for further processing.
+
+    Preprocessing options (all disabled by default):
+    - max_size: downscale the image so its largest side is at most this many pixels
+    - min_area, min_length: discard contours with a smaller area or arc length
+    - outer_only: only keep outermost contours of the contour hierarchy
+    - epsilon: approximate contours with approxPolyDP, with this tolerance
+
+    Contour coordinates are always returned in the original image resolution.
     """
-    contours, _ = get_contours(img)
+    img, scale = downscale(img, max_size=max_size)
+
+    contours, hierarchy = get_contours(img, outer_only=outer_only)
+
+    contours = filter_contours(contours, 
+                               min_area=min_area*(scale**2), 
+                               min_length=min_length*scale, 
+                               epsilon=None if epsilon is None else epsilon*scale)
 
     line_strings = []
     for c in contours:
@@ -34,6 +114,9 @@ def get_image_line_strings(img, step=DEFAULT_STEP):
         if s > 1:
             points = resize(c, (s, 2))
 
+            if scale != 1.0:
+                points = points / scale
+
             rounded = snap_round(points, step=step)
 
             ls = to_line_string(rounded) 
@@ -42,10 +125,34 @@ def get_image_line_strings(img, step=DEFAULT_STEP):
 
     return line_strings
 
-def get_contours(img):
+def downscale(img, max_size=None):
+    """
+    Downscales an image so that its largest side is at most max_size pixels.
+    Returns the (possibly unmodified) image and the scale factor applied to it.
+    """
+    import cv2
+
+    if max_size is None:
+        return img, 1.0
+
+    h, w = img.shape[:2]
+    if max(h, w) <= max_size:
+        return img, 1.0
+
+    scale = max_size / max(h, w)
+    size  = (max(1, round(w*scale)), max(1, round(h*scale)))
+
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA), scale
+
+@staged('get_contours', lambda result, *args, **kwargs: {'contours': len(result[0])})
+def get_contours(img, outer_only=False):
     """
     Retrieves the contours of the image.
+
+    If outer_only is set, only the outermost contours of the hierarchy are retrieved.
     """
+    import cv2
+
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     blur = cv2.medianBlur(gray, 7)
@@ -53,14 +160,40 @@ def get_contours(img):
     ret, thresh = cv2.threshold(blur, 127, 255, cv2.THRESH_BINARY)
     # thresh = cv2.Canny(img,100,200)
 
-    contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    mode = cv2.RETR_EXTERNAL if outer_only else cv2.RETR_TREE
+
+    contours, hierarchy = cv2.findContours(thresh, mode, cv2.CHAIN_APPROX_SIMPLE)
 
     return contours, hierarchy
 
+def filter_contours(contours, min_area=0, min_length=0, epsilon=None):
+    """
+    Discards contours smaller than the given area and arc length, 
+    and approximates the remaining ones if an epsilon is given.
+    """
+    import cv2
+
+    filtered = []
+    for c in contours:
+        if min_area > 0 and cv2.contourArea(c) < min_area:
+            continue
+
+        if min_length > 0 and cv2.arcLength(c, True) < min_length:
+            continue
+
+        if epsilon is not None:
+            c = cv2.approxPolyDP(c, epsilon, True)
+
+        filtered.append(c)
+
+    return filtered
+
 def draw_contours(img, contours):
     """
     Draws the extracted contours of an image onto it.
     """
+    import cv2
+
     for i in range(len(contours)):
         img2 = cv2.drawContours(img.copy(), contours, i, (0,255,0), 3)
         display_image(img2)